@@ -7,6 +7,23 @@ import re
 import unicodedata
 import html
 from difflib import SequenceMatcher
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import hashlib
+import os
+import pickle
+import io
+import time
+import tempfile
+import threading
+import json
+import requests
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+from fifo_filas import consumir_filas_fifo, fifo_particao, montar_filas_fifo
 
 # --------------------------------------------------
 # CONFIG BÁSICA
@@ -23,6 +40,57 @@ URL_PLANILHA = "https://docs.google.com/spreadsheets/d/1TsRjsfw1TVfeEWBBvhKvsGQ5
 # custo unitário máximo plausível (acima disso é dado zoado)
 CUSTO_MAX_PLAUSIVEL = 500.0
 
+# motores do FIFO: o loop é a referência; o vetorizado é para históricos grandes
+FIFO_BACKENDS = {
+    "loop": "Loop (fila por produto)",
+    "vetorizado": "Vetorizado (searchsorted)",
+    "paralelo": "Paralelo (processos por produto)",
+}
+# abaixo disso o custo de subir processos não compensa e o paralelo roda em série
+FIFO_PARALELO_MIN_VENDAS = 50_000
+
+# arquivos locais (checkpoints e snapshots) ficam ao lado do app
+PASTA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+# um checkpoint por motor FIFO ({backend}): cada motor retoma só do próprio estado
+CHECKPOINT_FIFO = os.path.join(PASTA_CACHE, "fifo_checkpoint_{backend}.pkl")
+# última planilha baixada + ETag/Last-Modified, para o GET condicional
+ARQ_PLANILHA = os.path.join(PASTA_CACHE, "planilha.xlsx")
+META_PLANILHA = os.path.join(PASTA_CACHE, "planilha_meta.json")
+TIMEOUT_DOWNLOAD = 30
+# de quanto em quanto tempo (s) a thread de fundo confere a planilha de novo
+INTERVALO_ATUALIZACAO = 10 * 60
+# grafo produto -> similares (nome, score), reaproveitado entre reruns e sessões
+GRAFO_SIMILARES = os.path.join(PASTA_CACHE, "grafo_similares.pkl")
+GRAFO_VIZINHOS = 5
+GRAFO_MIN_SCORE = 0.34
+# similares: acima desse nº de produtos o modo "auto" troca a busca exata pelo MinHash/LSH
+SIMILARIDADE_LIMITE_LSH = 20_000
+# botão de recall/velocidade do MinHash: mais bandas = mais recall, mais candidatos
+MINHASH_BANDAS = 32
+MINHASH_LINHAS_POR_BANDA = 2
+# matriz de vendas por dia: só esses dias em volta de hoje têm coluna própria;
+# o resto vai para dois baldes (antes/depois). Cobre com folga as janelas 30/60/90.
+MATRIZ_DIAS_HISTORICO = 400
+MATRIZ_DIAS_FUTURO = 31
+# quantos reruns o painel de debug (?debug=1) guarda no histórico
+HISTORICO_TEMPOS = 30
+# abas já limpas, por hash do xlsx: o cold start pula o parse do openpyxl
+PREFIXO_SNAPSHOT_ABAS = "abas_"
+# subir quando limpar_aba/detecção de cabeçalho mudar: invalida os snapshots antigos
+VERSAO_LIMPEZA_ABAS = 1
+
+try:
+    import pyarrow  # noqa: F401  (opcional: snapshot em Parquet; sem ele vai pickle)
+    TEM_PYARROW = True
+except ImportError:
+    TEM_PYARROW = False
+
+try:
+    import python_calamine  # noqa: F401  (opcional: leitor de xlsx em Rust, bem mais rápido)
+    ENGINE_XLSX = "calamine"
+except ImportError:
+    ENGINE_XLSX = "openpyxl"
+
 # --------------------------------------------------
 # ESTILO GLOBAL (CSS) – preto básico, elegante, sem neon
 # --------------------------------------------------
@@ -767,6 +835,114 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# --------------------------------------------------
+# DESEMPENHO (painel de debug, abre com ?debug=1)
+# --------------------------------------------------
+_INICIO_RERUN = time.perf_counter()
+_TEMPOS_RERUN = {}
+
+if str(st.query_params.get("debug", "")) == "1":
+    st.session_state["_debug"] = True
+
+
+
+def _desligar_perfil():
+    """Desliga o cProfile ligado na sessão (se houver) e guarda o relatório.
+
+    Pode ser chamada mais de uma vez: só a primeira faz algo.
+    """
+    perfil = st.session_state.pop("_perfil_ativo", None)
+    if perfil is None:
+        return
+    perfil.disable()
+    saida = io.StringIO()
+    pstats.Stats(perfil, stream=saida).sort_stats("cumulative").print_stats(30)
+    st.session_state["_cprofile_txt"] = saida.getvalue()
+
+
+def parar_rerun():
+    """st.stop() que desliga o cProfile antes (fechar_rerun não roda depois do stop)."""
+    _desligar_perfil()
+    st.stop()
+
+
+def refazer_rerun():
+    """st.rerun() que desliga o cProfile antes (fechar_rerun não roda depois do rerun)."""
+    _desligar_perfil()
+    st.rerun()
+
+
+# Se um rerun anterior saiu por exceção, o profiler dele ainda está ligado.
+_desligar_perfil()
+if st.session_state.get("_debug") and st.session_state.get("_debug_cprofile"):
+    _perfil = cProfile.Profile()
+    try:
+        _perfil.enable()
+        st.session_state["_perfil_ativo"] = _perfil
+    except ValueError:  # já tem outro profiler ligado neste processo
+        pass
+
+
+@contextmanager
+def medir_etapa(nome):
+    """Soma o tempo do bloco em _TEMPOS_RERUN[nome]; etapas repetidas no rerun acumulam."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        _TEMPOS_RERUN[nome] = _TEMPOS_RERUN.get(nome, 0.0) + (time.perf_counter() - inicio)
+
+
+def fechar_rerun(tela, produtos=(), leitura=None):
+    """Guarda os tempos deste rerun no histórico da sessão e mostra o painel de debug.
+
+    `produtos` é o catálogo usado no teste de recall do MinHash. `leitura` é o
+    dict de carregar_dados; o tempo dele é de quando a planilha foi lida (pode ser
+    de outro rerun), então fica num campo à parte e não entra nas etapas.
+    """
+    total = time.perf_counter() - _INICIO_RERUN
+    medido = sum(_TEMPOS_RERUN.values())
+    registro = {
+        "quando": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "tela": tela,
+        "total_s": round(total, 4),
+        "etapas_s": {k: round(v, 4) for k, v in _TEMPOS_RERUN.items()},
+        "resto_s": round(max(0.0, total - medido), 4),
+        "leitura_planilha_s": round(leitura["segundos"], 4) if leitura else None,
+    }
+    historico = st.session_state.setdefault("_historico_tempos", [])
+    historico.append(registro)
+    del historico[:-HISTORICO_TEMPOS]
+
+    _desligar_perfil()
+
+    if not st.session_state.get("_debug"):
+        return
+    with st.expander("🛠️ Debug de desempenho", expanded=False):
+        st.caption(f"Rerun atual: {total:.3f} s ({tela}); fora das etapas medidas: {registro['resto_s']:.3f} s")
+        if leitura:
+            st.caption(f"Última leitura da planilha: {leitura['segundos']:.3f} s ({leitura['fonte']}), não somada ao rerun")
+        st.dataframe(
+            pd.DataFrame(sorted(_TEMPOS_RERUN.items(), key=lambda kv: -kv[1]), columns=["Etapa", "Segundos"]),
+            use_container_width=True,
+            hide_index=True,
+        )
+        hist = pd.DataFrame([{"quando": h["quando"], "tela": h["tela"], "total_s": h["total_s"], "leitura_planilha_s": h.get("leitura_planilha_s"), **h["etapas_s"]} for h in historico])
+        st.markdown("**Histórico dos últimos reruns**")
+        st.dataframe(hist.iloc[::-1], use_container_width=True, hide_index=True)
+        st.download_button(
+            "⬇️ Exportar histórico (JSON)",
+            data=json.dumps(historico, ensure_ascii=False, indent=2),
+            file_name="tempos_dashboard.json",
+            mime="application/json",
+        )
+        if len(produtos) > 1 and st.button("Medir recall do MinHash vs. busca exata"):
+            st.json(medir_recall_minhash(produtos))
+        st.checkbox("Capturar cProfile a cada rerun", key="_debug_cprofile")
+        if st.session_state.get("_cprofile_txt"):
+            st.code(st.session_state["_cprofile_txt"], language="text")
+
+
 # --------------------------------------------------
 # HELPERS
 # --------------------------------------------------
@@ -801,6 +977,60 @@ def parse_money(x):
         return 0.0
 
 
+def _float_ou_zero(s):
+    try:
+        return float(s)
+    except Exception:
+        return 0.0
+
+
+def parse_money_series(valores):
+    """Versão de coluna do parse_money: mesmas regras, sem chamar função por célula.
+
+    Números passam direto; texto perde R$/espaços, troca o formato BR (1.234,56)
+    e vai para pd.to_numeric. Texto com 12+ dígitos e sem separador é lixo (0).
+    O pouco que o to_numeric recusa cai no float() do Python, como no parse_money.
+    """
+    s = valores if isinstance(valores, pd.Series) else pd.Series(valores)
+    if s.empty:
+        return pd.Series(0.0, index=s.index, dtype=float)
+    if pd.api.types.is_bool_dtype(s) or pd.api.types.is_numeric_dtype(s):
+        return s.astype(float).fillna(0.0)
+
+    # Colunas de dinheiro repetem muito valor: converte só os distintos.
+    codigos, distintos = pd.factorize(s.astype(object))
+    if len(distintos) < len(s):
+        conv = parse_money_series(pd.Series(np.asarray(distintos, dtype=object), dtype=object)).to_numpy(dtype=float)
+        conv = np.append(conv, 0.0)  # código -1 (vazio) cai no último = 0
+        return pd.Series(conv[codigos], index=s.index, dtype=float)
+
+    vals = s.to_numpy(dtype=object)
+    eh_num = np.fromiter((isinstance(x, (int, float)) for x in vals), dtype=bool, count=len(vals))
+    out = np.zeros(len(vals), dtype=float)
+    if eh_num.any():
+        out[eh_num] = pd.to_numeric(pd.Series(vals[eh_num]), errors="coerce").fillna(0.0).to_numpy(dtype=float)
+
+    resto = ~eh_num & pd.notna(vals)
+    if resto.any():
+        txt = pd.Series(vals[resto]).astype(str).str.strip()
+        vazio = (txt == "") | (txt.str.lower() == "nan")
+        txt = txt.str.replace("R$", "", regex=False).str.replace("r$", "", regex=False).str.replace(" ", "", regex=False)
+        tem_ponto = txt.str.contains(".", regex=False)
+        tem_virgula = txt.str.contains(",", regex=False)
+        lixo = ~tem_ponto & ~tem_virgula & (txt.str.len() >= 12)
+        if lixo.any():
+            lixo[lixo] = txt[lixo].map(lambda t: sum(ch.isdigit() for ch in t) >= 12)
+        txt = txt.mask(tem_ponto & tem_virgula, txt.str.replace(".", "", regex=False))
+        txt = txt.str.replace(",", ".", regex=False)
+        num = pd.to_numeric(txt, errors="coerce")
+        recusados = num.isna() & ~vazio & ~lixo
+        num = num.where(~vazio & ~lixo, 0.0).fillna(0.0)
+        if recusados.any():
+            num[recusados] = txt[recusados].map(_float_ou_zero)
+        out[resto] = num.to_numpy(dtype=float)
+    return pd.Series(out, index=s.index, dtype=float)
+
+
 def format_reais(v):
     try:
         v = float(v)
@@ -812,33 +1042,39 @@ def format_reais(v):
 
 
 
-def calcular_saldo_a_receber(row):
+def _coluna_ou(df, *nomes, padrao=0):
+    """Primeira coluna existente entre `nomes`; senão uma série constante."""
+    for nome in nomes:
+        if nome in df.columns:
+            return df[nome]
+    return pd.Series(padrao, index=df.index, dtype=object)
+
+
+def calcular_saldo_a_receber(df):
     """Saldo real do fiado. RESTANTE vazio = deve VALOR_TOTAL; preenchido = deve RESTANTE."""
-    valor_total = parse_money(row.get("VALOR_TOTAL", row.get("VALOR TOTAL", 0)))
-    restante_raw = row.get("RESTANTE", "")
-    if pd.isna(restante_raw) or str(restante_raw).strip() == "":
-        return float(valor_total)
-    return max(0.0, float(parse_money(restante_raw)))
+    valor_total = parse_money_series(_coluna_ou(df, "VALOR_TOTAL", "VALOR TOTAL"))
+    restante_raw = _coluna_ou(df, "RESTANTE", padrao="")
+    vazio = restante_raw.isna() | restante_raw.astype(str).str.strip().eq("")
+    restante = parse_money_series(restante_raw).clip(lower=0.0)
+    return valor_total.where(vazio, restante).astype(float)
+
 
+def _proporcional_a_receber(df, coluna):
+    valor_total = parse_money_series(_coluna_ou(df, "VALOR_TOTAL", "VALOR TOTAL"))
+    total = parse_money_series(_coluna_ou(df, coluna))
+    saldo = calcular_saldo_a_receber(df)
+    fator = (saldo / valor_total.where(valor_total > 0)).clip(upper=1.0)
+    return (total * fator).where(valor_total > 0, 0.0).astype(float)
 
-def calcular_lucro_a_receber(row):
+
+def calcular_lucro_a_receber(df):
     """Lucro proporcional ao saldo que ainda falta receber."""
-    valor_total = parse_money(row.get("VALOR_TOTAL", row.get("VALOR TOTAL", 0)))
-    lucro_total = parse_money(row.get("LUCRO", 0))
-    saldo = calcular_saldo_a_receber(row)
-    if valor_total <= 0:
-        return 0.0
-    return float(lucro_total) * min(1.0, saldo / float(valor_total))
+    return _proporcional_a_receber(df, "LUCRO")
 
 
-def calcular_custo_proporcional_a_receber(row):
+def calcular_custo_proporcional_a_receber(df):
     """Custo proporcional ao saldo que ainda falta receber."""
-    valor_total = parse_money(row.get("VALOR_TOTAL", row.get("VALOR TOTAL", 0)))
-    custo_total = parse_money(row.get("CUSTO_TOTAL", 0))
-    saldo = calcular_saldo_a_receber(row)
-    if valor_total <= 0:
-        return 0.0
-    return float(custo_total) * min(1.0, saldo / float(valor_total))
+    return _proporcional_a_receber(df, "CUSTO_TOTAL")
 
 def ensure_df(obj):
     """Garante um DataFrame (mesmo se vier torto)."""
@@ -925,25 +1161,70 @@ def _norm_col(c):
     return s
 
 
-def detectar_linha_cabecalho(df_raw: pd.DataFrame, must_have):
+def _linhas_com_cabecalho(bloco: pd.DataFrame, must_have):
+    """Máscara das linhas do bloco que têm todas as palavras de must_have (mesma regra do _norm_col)."""
+    if bloco.empty:
+        return np.zeros(len(bloco), dtype=bool)
+    mat = np.char.upper(np.char.strip(np.asarray(bloco.to_numpy(dtype=object), dtype=str)))
+    mat = np.where(np.isin(mat, ["NAN", "NONE", "NAT"]), "", mat)
+    ok = np.ones(len(mat), dtype=bool)
+    for pal in must_have:
+        ok &= (np.char.find(mat, pal) >= 0).any(axis=1)
+    return ok
+
+
+@st.cache_resource
+def _cabecalhos_conhecidos():
+    """Linha do cabeçalho já achada por layout (aba, palavras, nº de colunas)."""
+    return {}
+
+
+def detectar_linha_cabecalho(df_raw: pd.DataFrame, must_have, layout=None):
     """Acha a linha do cabeçalho mesmo quando a coluna DATA está vazia.
 
     Na sua aba VENDAS, a célula do cabeçalho da DATA está em branco,
     mas a linha correta tem PRODUTO, QTD, VALOR TOTAL, STATUS e CLIENTE.
     A versão antiga exigia a palavra DATA e caía para a linha 0, onde só existe
     o título "VENDAS"; por isso todas as colunas viravam NAN.
+
+    Com `layout`, reaproveita a linha achada antes para o mesmo layout de aba e
+    só confere as linhas até ela; se não bater, refaz a busca nas 200 primeiras.
+    """
+    conhecidos = _cabecalhos_conhecidos() if layout is not None else {}
+    linha = conhecidos.get(layout)
+    if linha is not None and linha < len(df_raw):
+        ok = _linhas_com_cabecalho(df_raw.iloc[: linha + 1], must_have)
+        if ok[-1] and not ok[:-1].any():
+            return linha
+
+    achadas = np.flatnonzero(_linhas_com_cabecalho(df_raw.iloc[:200], must_have))
+    if len(achadas) == 0:
+        return None
+    linha = int(achadas[0])
+    if layout is not None:
+        conhecidos[layout] = linha
+    return linha
+
+
+def ler_abas_brutas(conteudo: bytes, abas, engine=ENGINE_XLSX):
+    """Lê as abas do xlsx sem cabeçalho.
+
+    Com calamine (Rust, solta o GIL) vai uma thread por aba. No openpyxl as
+    threads só disputam o GIL e cada uma reabre o arquivo, então abre um
+    ExcelFile só e lê as abas em sequência.
     """
-    max_linhas = min(200, len(df_raw))
-    for i in range(max_linhas):
-        cols = [_norm_col(x) for x in df_raw.iloc[i].tolist()]
-        linha = " ".join([c for c in cols if c])
-        if all(pal in linha for pal in must_have):
-            return i
-    return None
+    if engine == "calamine":
+        def _ler(aba):
+            return pd.read_excel(io.BytesIO(conteudo), sheet_name=aba, header=None, engine=engine)
 
+        with ThreadPoolExecutor(max_workers=len(abas)) as pool:
+            return dict(zip(abas, pool.map(_ler, abas)))
 
-def limpar_aba(xls, nome_aba):
-    df_raw = pd.read_excel(xls, sheet_name=nome_aba, header=None)
+    with pd.ExcelFile(io.BytesIO(conteudo), engine=engine) as xls:
+        return {aba: xls.parse(aba, header=None) for aba in abas}
+
+
+def limpar_aba(df_raw, nome_aba):
     aba = nome_aba.upper().strip()
 
     if aba == "COMPRAS":
@@ -956,10 +1237,10 @@ def limpar_aba(xls, nome_aba):
     else:
         must_have = ["PRODUTO"]
 
-    linha_header = detectar_linha_cabecalho(df_raw, must_have)
+    linha_header = detectar_linha_cabecalho(df_raw, must_have, layout=(aba, tuple(must_have), df_raw.shape[1]))
     if linha_header is None:
-        st.error(f"Não encontrei o cabeçalho da aba {nome_aba}. Verifique se a linha contém: {must_have}")
-        st.stop()
+        # Pode rodar na thread de fundo, onde st.error/st.stop não fazem nada: quem chama mostra.
+        raise ValueError(f"Não encontrei o cabeçalho da aba {nome_aba}. Verifique se a linha contém: {must_have}")
 
     cabecalho = [_norm_col(c) for c in df_raw.iloc[linha_header].tolist()]
 
@@ -996,18 +1277,449 @@ def limpar_aba(xls, nome_aba):
     return df
 
 
-@st.cache_data
-def carregar_dados():
-    xls = pd.ExcelFile(URL_PLANILHA)
-    df_compras = limpar_aba(xls, "COMPRAS")
-    df_vendas = limpar_aba(xls, "VENDAS")
-    return df_compras, df_vendas
+def fingerprint_dados(df_compras: pd.DataFrame, df_vendas: pd.DataFrame):
+    """Impressão digital do conteúdo bruto de COMPRAS/VENDAS (muda só quando a planilha muda)."""
+    h = hashlib.sha1()
+    for df in (df_compras, df_vendas):
+        h.update("|".join(map(str, df.columns)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def detectar_delta(antigo: pd.DataFrame, novo: pd.DataFrame):
+    """Compara duas versões limpas da mesma aba pelo hash de cada linha, na ordem.
+
+    Devolve {"tipo", "novas"}: tipo é "igual", "anexo" (as linhas antigas estão
+    intactas, na mesma posição, e só entraram linhas no fim) ou "completo"
+    (qualquer outra mudança). novas é o nº de linhas anexadas, só no "anexo".
+    Não tenta dizer quais linhas mudaram: com linhas repetidas isso não é confiável.
+    """
+    if antigo is None or list(antigo.columns) != list(novo.columns) or len(novo) < len(antigo):
+        return {"tipo": "completo", "novas": 0}
+    h_antigo = pd.util.hash_pandas_object(antigo, index=False).to_numpy()
+    h_novo = pd.util.hash_pandas_object(novo, index=False).to_numpy()
+    if not np.array_equal(h_antigo, h_novo[: len(h_antigo)]):
+        return {"tipo": "completo", "novas": 0}
+    novas = len(h_novo) - len(h_antigo)
+    return {"tipo": "anexo" if novas else "igual", "novas": novas}
+
+
+def delta_so_anexo(delta):
+    """True se nenhuma aba teve linha alterada/removida (None = sem versão anterior para comparar)."""
+    return delta is None or all(d["tipo"] in ("igual", "anexo") for d in delta.values())
+
+
+def _temporario_ao_lado(caminho):
+    """Arquivo temporário único na mesma pasta (o os.replace precisa do mesmo disco).
+
+    Thread de fundo, botão e outras sessões podem gravar o mesmo destino ao
+    mesmo tempo; um .tmp fixo deixaria as escritas se misturarem.
+    """
+    pasta = os.path.dirname(caminho)
+    os.makedirs(pasta, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=pasta, prefix=f".{os.path.basename(caminho)}.", suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+def _gravar_atomico(caminho, conteudo: bytes):
+    tmp = _temporario_ao_lado(caminho)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(conteudo)
+        os.replace(tmp, caminho)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def baixar_planilha(url=URL_PLANILHA, arquivo=ARQ_PLANILHA, arquivo_meta=META_PLANILHA, timeout=TIMEOUT_DOWNLOAD):
+    """Devolve (bytes do xlsx, sha1 do conteúdo, origem), baixando só quando mudou.
+
+    Guarda a última cópia em disco com ETag/Last-Modified e manda GET condicional;
+    304 reaproveita o arquivo. Sem rede, usa a cópia em disco se existir.
+    Caminho local (sem http) é lido direto, útil para rodar offline.
+    """
+    if not str(url).lower().startswith(("http://", "https://")):
+        with open(url, "rb") as f:
+            conteudo = f.read()
+        return conteudo, hashlib.sha1(conteudo).hexdigest(), "local"
+
+    meta = {}
+    if os.path.exists(arquivo) and os.path.exists(arquivo_meta):
+        try:
+            with open(arquivo_meta, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception:
+            meta = {}
+
+    def _do_disco(origem):
+        with open(arquivo, "rb") as f:
+            conteudo = f.read()
+        return conteudo, meta.get("sha1") or hashlib.sha1(conteudo).hexdigest(), origem
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        resp = requests.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        if meta:
+            return _do_disco("offline")
+        raise
+
+    if resp.status_code == 304 and meta:
+        return _do_disco("sem mudança")
+    resp.raise_for_status()
+
+    conteudo = resp.content
+    sha1 = hashlib.sha1(conteudo).hexdigest()
+    try:
+        if sha1 != meta.get("sha1"):
+            _gravar_atomico(arquivo, conteudo)
+        novo_meta = {
+            "sha1": sha1,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
+        _gravar_atomico(arquivo_meta, json.dumps(novo_meta).encode("utf-8"))
+    except OSError:
+        pass
+    return conteudo, sha1, "baixada" if sha1 != meta.get("sha1") else "sem mudança"
+
+
+def _prefixo_snapshot(hash_planilha):
+    return f"{PREFIXO_SNAPSHOT_ABAS}v{VERSAO_LIMPEZA_ABAS}_{hash_planilha}_"
+
+
+def _caminho_snapshot(hash_planilha, aba, ext, pasta=PASTA_CACHE):
+    return os.path.join(pasta, f"{_prefixo_snapshot(hash_planilha)}{aba}.{ext}")
+
+
+def ler_snapshot_abas(hash_planilha, abas, pasta=PASTA_CACHE):
+    """Abas limpas gravadas para esse xlsx, ou None se faltar alguma.
+
+    Parquet volta por memory map; o que não coube em Parquet está em pickle.
+    """
+    frames = {}
+    for aba in abas:
+        parquet = _caminho_snapshot(hash_planilha, aba, "parquet", pasta)
+        pkl = _caminho_snapshot(hash_planilha, aba, "pkl", pasta)
+        try:
+            if TEM_PYARROW and os.path.exists(parquet):
+                frames[aba] = pd.read_parquet(parquet, memory_map=True)
+            elif os.path.exists(pkl):
+                with open(pkl, "rb") as f:
+                    frames[aba] = pickle.load(f)
+            else:
+                return None
+        except Exception:
+            return None
+    return frames
+
+
+def gravar_snapshot_abas(hash_planilha, frames, pasta=PASTA_CACHE):
+    """Grava as abas limpas e apaga snapshots de planilhas antigas.
+
+    Só fica em Parquet a aba que volta idêntica (colunas com tipos misturados,
+    comuns na planilha, não voltam); as outras vão em pickle.
+    """
+    try:
+        os.makedirs(pasta, exist_ok=True)
+        for aba, df in frames.items():
+            gravado = False
+            if TEM_PYARROW:
+                destino = _caminho_snapshot(hash_planilha, aba, "parquet", pasta)
+                tmp = _temporario_ao_lado(destino)
+                try:
+                    df.to_parquet(tmp, index=True)
+                    if pd.read_parquet(tmp).equals(df):
+                        os.replace(tmp, destino)
+                        gravado = True
+                except Exception:
+                    pass
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            if not gravado:
+                _gravar_atomico(
+                    _caminho_snapshot(hash_planilha, aba, "pkl", pasta),
+                    pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL),
+                )
+        for nome in os.listdir(pasta):
+            if nome.startswith(PREFIXO_SNAPSHOT_ABAS) and not nome.startswith(_prefixo_snapshot(hash_planilha)):
+                os.remove(os.path.join(pasta, nome))
+    except OSError:
+        pass
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def ler_planilha(_conteudo: bytes, hash_planilha: str):
+    """Parse + limpeza das abas, guardado pelo hash do xlsx (mesmo arquivo = sem parse).
+
+    Depois de um restart, as abas limpas voltam do snapshot em disco.
+    Devolve também {"fonte", "segundos"} de como a leitura foi feita.
+    """
+    inicio = time.perf_counter()
+    abas = ["COMPRAS", "VENDAS"]
+    frames = ler_snapshot_abas(hash_planilha, abas)
+    fonte = "snapshot"
+    if frames is None:
+        brutas = ler_abas_brutas(_conteudo, abas)
+        frames = {aba: limpar_aba(brutas[aba], aba) for aba in abas}
+        gravar_snapshot_abas(hash_planilha, frames)
+        fonte = ENGINE_XLSX
+    df_compras, df_vendas = frames["COMPRAS"], frames["VENDAS"]
+    leitura = {"fonte": fonte, "segundos": time.perf_counter() - inicio}
+    return df_compras, df_vendas, fingerprint_dados(df_compras, df_vendas), leitura
+
+
+def normalizar_compras(df_compras):
+    """COMPRAS tipada: colunas em maiúsculo, DATA datetime64, QUANTIDADE/CUSTO em float64."""
+    compras = ensure_df(df_compras).copy()
+    compras.columns = [str(c).strip().upper() for c in compras.columns]
+    if "DATA" in compras.columns:
+        compras["DATA"] = pd.to_datetime(compras["DATA"], errors="coerce", dayfirst=True)
+        compras["MES_ANO"] = compras["DATA"].dt.strftime("%Y-%m")
+    for col in ["QUANTIDADE", "CUSTO UNITÁRIO"]:
+        if col in compras.columns:
+            compras[col] = parse_money_series(compras[col])
+    if "QUANTIDADE" in compras.columns and "CUSTO UNITÁRIO" in compras.columns:
+        compras["CUSTO_TOTAL"] = compras["QUANTIDADE"] * compras["CUSTO UNITÁRIO"]
+    return compras
+
+
+def normalizar_vendas(df_vendas):
+    """VENDAS tipada: colunas em maiúsculo, DATA datetime64, QTD/VALOR TOTAL em float64."""
+    vendas = ensure_df(df_vendas).copy()
+    vendas.columns = [str(c).strip().upper() for c in vendas.columns]
+    if "DATA" in vendas.columns:
+        vendas["DATA"] = pd.to_datetime(vendas["DATA"], errors="coerce", dayfirst=True)
+    for col in ["QTD", "VALOR TOTAL"]:
+        if col in vendas.columns:
+            vendas[col] = parse_money_series(vendas[col])
+    return vendas
+
+
+def filtrar_entregues(compras):
+    """Só as compras com STATUS = ENTREGUE (a base do FIFO e dos totais de compra)."""
+    if "STATUS" not in compras.columns:
+        return compras
+    return compras[compras["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def carregar_base(_df_compras: pd.DataFrame, _df_vendas: pd.DataFrame, versao: str):
+    """Base canônica por versão dos dados: (compras, compras ENTREGUE, vendas), já tipadas.
+
+    As telas leem daqui em vez de refazer maiúsculas, datas e parse_money cada uma.
+    """
+    compras = normalizar_compras(_df_compras)
+    return compras, filtrar_entregues(compras), normalizar_vendas(_df_vendas)
 
 
 # --------------------------------------------------
 # FIFO
 # --------------------------------------------------
-def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame):
+COLS_LOTES_FIFO = ["PRODUTO", "QTD_REMANESCENTE", "DATA_LOTE", "CUSTO_UNIT", "VALOR_LOTE", "DIAS_PARADO_LOTE"]
+
+
+def _fifo_vetorizado(produtos_c, quantidades_c, custos_unit, datas, produtos_v, quantidades_v):
+    """Mesmo resultado de montar_filas_fifo + consumir_filas_fifo, sem loop por venda.
+
+    Os lotes de cada produto viram um intervalo na reta de quantidade acumulada;
+    cada venda ocupa [vendido_antes, vendido_antes + qtd) dentro do seu produto.
+    O custo da venda sai da diferença do custo acumulado nas duas pontas, com o
+    lote de cada ponta achado via np.searchsorted.
+    """
+    produtos_c = np.asarray(produtos_c, dtype=object)
+    quantidades_c = np.asarray(quantidades_c, dtype=float)
+    custos_unit = np.asarray(custos_unit, dtype=float)
+    datas = list(datas)
+    produtos_v = np.asarray(produtos_v, dtype=object)
+    quantidades_v = np.asarray(quantidades_v, dtype=float)
+
+    validos = np.flatnonzero(quantidades_c > 0)
+    codigos, _ = pd.factorize(np.concatenate([produtos_c[validos], produtos_v]))
+    cod_c = codigos[: len(validos)]
+    cod_v = codigos[len(validos):]
+    n_prod = int(codigos.max()) + 1 if len(codigos) else 0
+
+    # lotes agrupados por produto, mantendo a ordem da fila dentro do produto
+    ordem = validos[np.argsort(cod_c, kind="stable")]
+    cod_ord = np.sort(cod_c, kind="stable")
+    qtd_lote = quantidades_c[ordem]
+    custo_lote = custos_unit[ordem]
+    fim_lote = np.cumsum(qtd_lote)
+    inicio_lote = fim_lote - qtd_lote
+    custo_acum = np.cumsum(qtd_lote * custo_lote)
+
+    total_prod = np.bincount(cod_ord, weights=qtd_lote, minlength=n_prod)
+    base_prod = np.cumsum(total_prod) - total_prod
+
+    def _custo_ate(pos):
+        if not len(fim_lote):
+            return np.zeros(len(pos), dtype=float)
+        j = np.minimum(np.searchsorted(fim_lote, pos, side="left"), len(fim_lote) - 1)
+        return custo_acum[j] - (fim_lote[j] - pos) * custo_lote[j]
+
+    qtd_venda = np.where(quantidades_v > 0, quantidades_v, 0.0)
+    vendido_ate = pd.Series(qtd_venda).groupby(cod_v).cumsum().to_numpy()
+    teto = total_prod[cod_v]
+    pos_fim = base_prod[cod_v] + np.minimum(vendido_ate, teto)
+    pos_ini = base_prod[cod_v] + np.minimum(vendido_ate - qtd_venda, teto)
+    custos = np.where(pos_fim > pos_ini, _custo_ate(pos_fim) - _custo_ate(pos_ini), 0.0)
+
+    # saldo de cada lote depois de todas as vendas do produto
+    vendido_prod = np.minimum(np.bincount(cod_v, weights=qtd_venda, minlength=n_prod), total_prod)
+    consumido = (base_prod + vendido_prod)[cod_ord]
+    restante = np.where(
+        fim_lote <= consumido + 1e-9,
+        0.0,
+        np.where(inicio_lote >= consumido, qtd_lote, fim_lote - consumido),
+    )
+
+    saldo_lote = np.zeros(len(quantidades_c), dtype=float)
+    saldo_lote[ordem] = restante
+    estoque = {}
+    for i in np.flatnonzero(saldo_lote > 0):
+        produto = produtos_c[i]
+        fila = estoque.get(produto)
+        if fila is None:
+            fila = estoque[produto] = deque()
+        fila.append([float(saldo_lote[i]), float(custos_unit[i]), datas[i]])
+    return custos, estoque
+
+
+def _particionar_produtos(cod_c, cod_v, n_partes):
+    """Distribui os produtos em n_partes com carga parecida (maior primeiro, vai pro pedaço mais leve)."""
+    n_prod = int(max(cod_c.max(initial=-1), cod_v.max(initial=-1))) + 1
+    carga = np.bincount(cod_c, minlength=n_prod) + np.bincount(cod_v, minlength=n_prod)
+    parte_do_produto = np.zeros(n_prod, dtype=int)
+    carga_parte = np.zeros(n_partes, dtype=np.int64)
+    for cod in np.argsort(-carga, kind="stable"):
+        destino = int(np.argmin(carga_parte))
+        parte_do_produto[cod] = destino
+        carga_parte[destino] += carga[cod]
+    return parte_do_produto
+
+
+def _fifo_paralelo(lotes_cols, vendas_cols, n_workers=None):
+    """Replay FIFO com as filas de cada produto espalhadas num ProcessPoolExecutor.
+
+    Cada produto tem sua própria fila, então os pedaços não conversam entre si;
+    no fim os custos voltam para a posição original de cada venda. Os filhos
+    sobem com spawn (fork dentro do servidor multi-thread do Streamlit pode
+    travar) e só importam o fifo_filas. Com pouco volume roda o mesmo replay
+    em série.
+    """
+    n_workers = n_workers or min(8, os.cpu_count() or 1)
+    if n_workers < 2 or len(vendas_cols[0]) < FIFO_PARALELO_MIN_VENDAS:
+        return fifo_particao(lotes_cols, vendas_cols)
+
+    codigos, _ = pd.factorize(np.concatenate([lotes_cols[0], vendas_cols[0]]))
+    cod_c = codigos[: len(lotes_cols[0])]
+    cod_v = codigos[len(lotes_cols[0]):]
+    parte = _particionar_produtos(cod_c, cod_v, n_workers)
+    parte_c, parte_v = parte[cod_c], parte[cod_v]
+
+    pedacos = []
+    for p in range(n_workers):
+        idx_c = np.flatnonzero(parte_c == p)
+        idx_v = np.flatnonzero(parte_v == p)
+        if len(idx_c) or len(idx_v):
+            datas = lotes_cols[3]
+            pedacos.append((
+                idx_v,
+                tuple(col[idx_c] for col in lotes_cols[:3]) + ([datas[i] for i in idx_c],),
+                tuple(col[idx_v] for col in vendas_cols),
+            ))
+
+    custos = np.zeros(len(vendas_cols[0]), dtype=float)
+    estoque = {}
+    try:
+        with ProcessPoolExecutor(max_workers=len(pedacos), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futuros = [(idx_v, pool.submit(fifo_particao, lc, vc)) for idx_v, lc, vc in pedacos]
+            for idx_v, futuro in futuros:
+                custos_parte, estoque_parte = futuro.result()
+                custos[idx_v] = custos_parte
+                estoque.update(estoque_parte)
+    except Exception:
+        return fifo_particao(lotes_cols, vendas_cols)
+    return custos, estoque
+
+
+def _hash_linhas(df: pd.DataFrame):
+    """Hash por linha (uint64) das colunas que mexem no FIFO."""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def _hash_prefixo(hashes, n):
+    return hashlib.sha1(np.ascontiguousarray(hashes[:n]).tobytes()).hexdigest()
+
+
+def _produtos_com_falta(lotes_cols, vendas_cols):
+    """Produtos em que alguma venda ficou sem lote para consumir (vendeu mais do que comprou)."""
+    comprado = pd.Series(np.where(lotes_cols[1] > 0, lotes_cols[1], 0.0)).groupby(lotes_cols[0]).sum()
+    vendido = pd.Series(np.where(vendas_cols[1] > 0, vendas_cols[1], 0.0)).groupby(vendas_cols[0]).sum()
+    saldo = vendido.sub(comprado, fill_value=0.0)
+    return set(saldo.index[saldo > 1e-9].tolist())
+
+
+def _ler_checkpoint_fifo(caminho):
+    try:
+        with open(caminho, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _gravar_checkpoint_fifo(caminho, estado):
+    """Grava o checkpoint de forma atômica (arquivo temporário + os.replace)."""
+    try:
+        _gravar_atomico(caminho, pickle.dumps(estado, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        pass
+
+
+def _fifo_incremental(lotes_cols, vendas_cols, hash_compras, hash_vendas, caminho, backend):
+    """Continua o replay a partir do checkpoint quando a planilha só ganhou linhas no fim.
+
+    Devolve (custos, estoque) ou None quando precisa de replay completo: checkpoint
+    ausente ou gravado por outro motor, alguma linha já processada mudou/saiu da
+    ordem, ou chegou lote novo de um produto que já tinha venda sem estoque (isso
+    mudaria o custo antigo).
+    """
+    ck = _ler_checkpoint_fifo(caminho)
+    if not ck or ck.get("versao") != 2 or ck.get("backend") != backend:
+        return None
+    n_c, n_v = ck["n_compras"], ck["n_vendas"]
+    if n_c > len(hash_compras) or n_v > len(hash_vendas):
+        return None
+    if _hash_prefixo(hash_compras, n_c) != ck["hash_compras"] or _hash_prefixo(hash_vendas, n_v) != ck["hash_vendas"]:
+        return None
+
+    novos_lotes = [col[n_c:] for col in lotes_cols]
+    if ck["faltou"] & set(novos_lotes[0][novos_lotes[1] > 0].tolist()):
+        return None
+
+    estoque = montar_filas_fifo(*novos_lotes, estoque=ck["estoque"])
+    custos_novos = consumir_filas_fifo(estoque, *[col[n_v:] for col in vendas_cols])
+    return np.concatenate([ck["custos"], custos_novos]), estoque
+
+
+def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame, backend="loop", checkpoint=None, retomar=True):
+    """Replay FIFO único: custo por venda, resumo do estoque e lotes que sobraram.
+
+    Uma passada só pelas compras ENTREGUE e pelas vendas alimenta as três tabelas,
+    então o saldo de df_estoque e a soma dos lotes em df_lotes_fifo sempre batem.
+    Com checkpoint (caminho de arquivo), só as linhas novas do fim são reprocessadas,
+    e só se o checkpoint foi gravado pelo mesmo backend; retomar=False força o
+    replay completo e só regrava o checkpoint.
+    Planilha sem colunas obrigatórias ou sem compra ENTREGUE válida levanta ValueError.
+    """
     compras = df_compras_raw.copy()
     vendas = df_vendas_raw.copy()
 
@@ -1020,31 +1732,30 @@ def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame):
     faltando_compras = [c for c in cols_compras_obrig if c not in compras.columns]
     faltando_vendas = [c for c in cols_vendas_obrig if c not in vendas.columns]
 
+    # Roda também na thread de atualização, onde st.error/st.stop não fazem nada:
+    # quem chama mostra a mensagem do ValueError.
     if faltando_compras:
-        st.error(
+        raise ValueError(
             f"Aba COMPRAS após limpeza ainda está sem colunas: {faltando_compras}. "
             f"Colunas atuais: {list(compras.columns)}"
         )
-        st.stop()
     if faltando_vendas:
-        st.error(
+        raise ValueError(
             f"Aba VENDAS após limpeza ainda está sem colunas: {faltando_vendas}. "
             f"Colunas atuais: {list(vendas.columns)}"
         )
-        st.stop()
 
     compras = compras[compras["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
     if compras.empty:
-        st.warning("Nenhuma compra com STATUS = ENTREGUE encontrada.")
-        return pd.DataFrame(), pd.DataFrame()
+        raise ValueError("Nenhuma compra com STATUS = ENTREGUE encontrada.")
 
     compras["DATA"] = pd.to_datetime(compras["DATA"], errors="coerce", dayfirst=True)
     vendas["DATA"] = pd.to_datetime(vendas["DATA"], errors="coerce", dayfirst=True)
-    compras = compras.sort_values("DATA")
-    vendas = vendas.sort_values("DATA")
+    compras = compras.sort_values("DATA", kind="stable")
+    vendas = vendas.sort_values("DATA", kind="stable")
 
-    compras["QUANTIDADE"] = compras["QUANTIDADE"].apply(parse_money).astype(float)
-    compras["CUSTO UNITÁRIO"] = compras["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
+    compras["QUANTIDADE"] = parse_money_series(compras["QUANTIDADE"])
+    compras["CUSTO UNITÁRIO"] = parse_money_series(compras["CUSTO UNITÁRIO"])
     compras["CUSTO TOTAL"] = compras["QUANTIDADE"] * compras["CUSTO UNITÁRIO"]
     compras["CUSTO_UNIT_CALC"] = compras["CUSTO TOTAL"] / compras["QUANTIDADE"].replace(0, pd.NA)
 
@@ -1055,63 +1766,65 @@ def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame):
     ].copy()
 
     if compras.empty:
-        st.warning("Todas as linhas de COMPRAS ficaram inválidas após o filtro de custo.")
-        return pd.DataFrame(), pd.DataFrame()
+        raise ValueError("Todas as linhas de COMPRAS ficaram inválidas após o filtro de custo.")
 
-    vendas["QTD"] = vendas["QTD"].apply(parse_money).astype(float)
-    vendas["VALOR TOTAL"] = vendas["VALOR TOTAL"].apply(parse_money).astype(float)
+    vendas["QTD"] = parse_money_series(vendas["QTD"])
+    vendas["VALOR TOTAL"] = parse_money_series(vendas["VALOR TOTAL"])
 
-    estoque = {}
-    for _, row in compras.iterrows():
-        produto = str(row["PRODUTO"])
-        qtd = float(row["QUANTIDADE"])
-        if qtd <= 0:
-            continue
-        custo_unit = float(row["CUSTO_UNIT_CALC"])
-
-        if produto not in estoque:
-            estoque[produto] = []
-        estoque[produto].append({"qtd": qtd, "custo": custo_unit})
-
-    registros_venda = []
-    for _, row in vendas.iterrows():
-        produto = str(row["PRODUTO"])
-        qtd_venda = float(row["QTD"])
-        valor_total = float(row["VALOR TOTAL"])
-        data_venda = row["DATA"]
-
-        restante = qtd_venda
-        custo_total = 0.0
-
-        if produto in estoque:
-            lotes = estoque[produto]
-            while restante > 0 and lotes:
-                lote = lotes[0]
-                if lote["qtd"] <= restante:
-                    custo_total += lote["qtd"] * lote["custo"]
-                    restante -= lote["qtd"]
-                    lotes.pop(0)
-                else:
-                    custo_total += restante * lote["custo"]
-                    lote["qtd"] -= restante
-                    restante = 0
-        else:
-            custo_total = 0.0
-
-        registros_venda.append(
-            {
-                "DATA": data_venda,
-                "PRODUTO": produto,
-                "QTD": qtd_venda,
-                "VALOR_TOTAL": valor_total,
-                "CUSTO_TOTAL": custo_total,
-                "CLIENTE": row.get("CLIENTE"),
-                "STATUS": row.get("STATUS"),
-                "RESTANTE": row.get("RESTANTE", ""),
-            }
-        )
+    lotes_cols = (
+        compras["PRODUTO"].astype(str).to_numpy(),
+        compras["QUANTIDADE"].to_numpy(dtype=float),
+        compras["CUSTO_UNIT_CALC"].to_numpy(dtype=float),
+        compras["DATA"].tolist(),
+    )
+    vendas_cols = (
+        vendas["PRODUTO"].astype(str).to_numpy(),
+        vendas["QTD"].to_numpy(dtype=float),
+    )
+    retomado = None
+    if checkpoint:
+        hash_compras = _hash_linhas(pd.DataFrame({
+            "PRODUTO": lotes_cols[0], "QTD": lotes_cols[1], "CUSTO": lotes_cols[2], "DATA": compras["DATA"].to_numpy(),
+        }))
+        hash_vendas = _hash_linhas(pd.DataFrame({
+            "PRODUTO": vendas_cols[0], "QTD": vendas_cols[1], "DATA": vendas["DATA"].to_numpy(),
+        }))
+        if retomar:
+            retomado = _fifo_incremental(lotes_cols, vendas_cols, hash_compras, hash_vendas, checkpoint, backend)
+
+    if retomado is not None:
+        custos, estoque = retomado
+    elif backend == "vetorizado":
+        custos, estoque = _fifo_vetorizado(*lotes_cols, *vendas_cols)
+    elif backend == "paralelo":
+        custos, estoque = _fifo_paralelo(lotes_cols, vendas_cols)
+    else:
+        estoque = montar_filas_fifo(*lotes_cols)
+        custos = consumir_filas_fifo(estoque, *vendas_cols)
+
+    if checkpoint:
+        _gravar_checkpoint_fifo(checkpoint, {
+            "versao": 2,
+            "backend": backend,
+            "n_compras": len(hash_compras),
+            "n_vendas": len(hash_vendas),
+            "hash_compras": _hash_prefixo(hash_compras, len(hash_compras)),
+            "hash_vendas": _hash_prefixo(hash_vendas, len(hash_vendas)),
+            "faltou": _produtos_com_falta(lotes_cols, vendas_cols),
+            "custos": custos,
+            "estoque": estoque,
+        })
 
-    df_fifo = pd.DataFrame(registros_venda)
+    df_fifo = pd.DataFrame({
+        "DATA": vendas["DATA"].to_numpy(),
+        "PRODUTO": vendas["PRODUTO"].astype(str).to_numpy(),
+        "QTD": vendas["QTD"].to_numpy(dtype=float),
+        "VALOR_TOTAL": vendas["VALOR TOTAL"].to_numpy(dtype=float),
+        "CUSTO_TOTAL": custos,
+        "CLIENTE": vendas["CLIENTE"].to_numpy(),
+        "STATUS": vendas["STATUS"].to_numpy(),
+        "RESTANTE": vendas["RESTANTE"].to_numpy() if "RESTANTE" in vendas.columns else "",
+    })
     df_fifo["CUSTO_UNIT"] = df_fifo["CUSTO_TOTAL"] / df_fifo["QTD"].replace(0, pd.NA)
 
     mask_insano = df_fifo["CUSTO_UNIT"] > CUSTO_MAX_PLAUSIVEL
@@ -1121,12 +1834,15 @@ def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame):
     df_fifo["LUCRO"] = df_fifo["VALOR_TOTAL"] - df_fifo["CUSTO_TOTAL"]
     df_fifo["MES_ANO"] = df_fifo["DATA"].dt.strftime("%Y-%m")
 
+    today = pd.Timestamp.now().normalize()
     estoque_reg = []
-    for produto, lotes in estoque.items():
-        saldo = sum(l["qtd"] for l in lotes)
+    lotes_reg = []
+    for produto in sorted(estoque):
+        lotes = estoque[produto]
+        saldo = sum(l[0] for l in lotes)
         if saldo <= 0:
             continue
-        valor = sum(l["qtd"] * l["custo"] for l in lotes)
+        valor = sum(l[0] * l[1] for l in lotes)
         custo_medio = valor / saldo if saldo else 0.0
         estoque_reg.append(
             {
@@ -1136,115 +1852,298 @@ def calcular_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame):
                 "CUSTO_MEDIO_FIFO": custo_medio,
             }
         )
+        for qtd, custo_unit, data_lote in lotes:
+            dias = (today - data_lote.normalize()).days if pd.notna(data_lote) else pd.NA
+            lotes_reg.append({
+                "PRODUTO": produto,
+                "QTD_REMANESCENTE": qtd,
+                "DATA_LOTE": data_lote,
+                "CUSTO_UNIT": custo_unit,
+                "VALOR_LOTE": qtd * custo_unit,
+                "DIAS_PARADO_LOTE": dias,
+            })
     df_estoque = pd.DataFrame(estoque_reg)
+    df_lotes_fifo = pd.DataFrame(lotes_reg, columns=COLS_LOTES_FIFO)
 
-    return df_fifo, df_estoque
+    return df_fifo, df_estoque, df_lotes_fifo
 
 
-def calcular_lotes_remanescentes_fifo(df_compras_raw: pd.DataFrame, df_vendas_raw: pd.DataFrame) -> pd.DataFrame:
-    compras = df_compras_raw.copy()
-    vendas = df_vendas_raw.copy()
+@st.cache_data(show_spinner=False, max_entries=6)
+def calcular_tabelas_fifo(_df_compras: pd.DataFrame, _df_vendas: pd.DataFrame, versao: str, backend: str, hoje: str, _delta=None):
+    """Tabelas derivadas do FIFO guardadas por versão dos dados.
 
-    compras.columns = [c.strip().upper() for c in compras.columns]
-    vendas.columns = [c.strip().upper() for c in vendas.columns]
+    Os DataFrames não entram na chave do cache (prefixo _): quem identifica o
+    conteúdo é a versao (fingerprint_dados). hoje entra na chave porque os dias
+    parados dos lotes mudam na virada do dia. _delta (detectar_delta contra a
+    versão anterior em memória) só evita tentar o checkpoint quando já se sabe
+    que linhas antigas mudaram; o hash de prefixo do checkpoint decide do mesmo
+    jeito, então o resultado não depende dele.
+    """
+    df_fifo, df_estoque, df_lotes_fifo = calcular_fifo(
+        _df_compras, _df_vendas, backend=backend, checkpoint=CHECKPOINT_FIFO.format(backend=backend), retomar=delta_so_anexo(_delta)
+    )
+    if not df_estoque.empty and ("PRODUTO" in df_estoque.columns) and ("SALDO_QTD" in df_estoque.columns):
+        estoque_map = df_estoque.set_index("PRODUTO")["SALDO_QTD"].to_dict()
+    else:
+        estoque_map = {}
+    return df_fifo, df_estoque, df_lotes_fifo, estoque_map
 
-    cols_compras_obrig = ["DATA", "PRODUTO", "STATUS", "QUANTIDADE", "CUSTO UNITÁRIO"]
-    cols_vendas_obrig = ["DATA", "PRODUTO", "QTD"]
 
-    if any(c not in compras.columns for c in cols_compras_obrig) or any(c not in vendas.columns for c in cols_vendas_obrig):
-        return pd.DataFrame(columns=["PRODUTO", "QTD_REMANESCENTE", "DATA_LOTE", "CUSTO_UNIT", "VALOR_LOTE", "DIAS_PARADO_LOTE"])
+def _linhas_com_produto_texto(df):
+    """Só as linhas cujo PRODUTO é texto: é o que casa com os nomes (str) da reposição."""
+    if "PRODUTO" not in df.columns:
+        return pd.DataFrame(columns=["PRODUTO", *df.columns])
+    if pd.api.types.is_string_dtype(df["PRODUTO"]):
+        return df
+    return df[df["PRODUTO"].map(lambda x: isinstance(x, str))]
 
-    compras = compras[compras["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
-    if compras.empty:
-        return pd.DataFrame(columns=["PRODUTO", "QTD_REMANESCENTE", "DATA_LOTE", "CUSTO_UNIT", "VALOR_LOTE", "DIAS_PARADO_LOTE"])
 
-    compras["DATA"] = pd.to_datetime(compras["DATA"], errors="coerce", dayfirst=True)
-    vendas["DATA"] = pd.to_datetime(vendas["DATA"], errors="coerce", dayfirst=True)
+def montar_matriz_diaria(df, col_qtd="QTD", hoje=None):
+    """Matriz produto x dia com a soma acumulada das quantidades vendidas.
 
-    compras["QUANTIDADE"] = compras["QUANTIDADE"].apply(parse_money).astype(float)
-    compras["CUSTO UNITÁRIO"] = compras["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
-    compras["CUSTO TOTAL"] = compras["QUANTIDADE"] * compras["CUSTO UNITÁRIO"]
-    compras["CUSTO_UNIT_CALC"] = compras["CUSTO TOTAL"] / compras["QUANTIDADE"].replace(0, pd.NA)
-    compras = compras[
-        (compras["CUSTO_UNIT_CALC"].notna())
-        & (compras["CUSTO_UNIT_CALC"] >= 0)
-        & (compras["CUSTO_UNIT_CALC"] <= CUSTO_MAX_PLAUSIVEL)
-        & (compras["QUANTIDADE"] > 0)
-        & (compras["DATA"].notna())
-    ].sort_values(["PRODUTO", "DATA"]).copy()
+    Só os dias de hoje - MATRIZ_DIAS_HISTORICO até hoje + MATRIZ_DIAS_FUTURO têm
+    coluna; vendas fora disso caem num balde "antes" ou "depois", então uma data
+    digitada errada (ano 2205) não estoura a memória. acum[i, k + 1] = vendido
+    pelo produto i antes do dia dia0+k (baldes incluídos) e a última coluna é o
+    total com data; qualquer janela dentro do intervalo é uma subtração por
+    produto. "total" inclui as linhas sem data.
+    """
+    df = _linhas_com_produto_texto(df)
+    codigos, produtos = pd.factorize(df["PRODUTO"], sort=False)
+    qtd = pd.to_numeric(df[col_qtd], errors="coerce").fillna(0.0).to_numpy(dtype=float)
+    n = len(produtos)
+    com_produto = codigos >= 0
+    total = np.bincount(codigos[com_produto], weights=qtd[com_produto], minlength=n)
+
+    hoje = (pd.Timestamp.now() if hoje is None else pd.Timestamp(hoje)).normalize()
+    inicio = hoje - pd.Timedelta(days=MATRIZ_DIAS_HISTORICO)
+    fim = hoje + pd.Timedelta(days=MATRIZ_DIAS_FUTURO)
+    dias = pd.to_datetime(df["DATA"], errors="coerce").dt.normalize()
+    com_data = dias.notna().to_numpy() & com_produto
+    if com_data.any():
+        dias_ok = dias[com_data]
+        dia0 = min(max(dias_ok.min(), inicio), fim)
+        n_dias = (min(max(dias_ok.max(), inicio), fim) - dia0).days + 1
+        # coluna 0 = antes de dia0, 1..n_dias = dias, n_dias + 1 = depois do último
+        idx_dia = np.clip((dias_ok - dia0).dt.days.to_numpy() + 1, 0, n_dias + 1)
+        largura = n_dias + 2
+        diario = np.bincount(codigos[com_data] * largura + idx_dia, weights=qtd[com_data], minlength=n * largura)
+        diario = diario.reshape(n, largura)
+    else:
+        dia0, n_dias, diario = hoje, 0, np.zeros((n, 2))
+    acum = np.zeros((n, n_dias + 3))
+    np.cumsum(diario, axis=1, out=acum[:, 1:])
+    return {
+        "produtos": list(produtos),
+        "posicao": {p: i for i, p in enumerate(produtos)},
+        "dia0": dia0,
+        "acum": acum,
+        "total": total,
+        "fora_janela": diario[:, 0] + diario[:, -1],
+    }
 
-    vendas["QTD"] = vendas["QTD"].apply(parse_money).astype(float)
-    vendas = vendas[(vendas["QTD"] > 0) & (vendas["DATA"].notna())].sort_values(["PRODUTO", "DATA"]).copy()
 
-    estoque = {}
-    for _, row in compras.iterrows():
-        produto = str(row["PRODUTO"])
-        estoque.setdefault(produto, []).append({
-            "qtd": float(row["QUANTIDADE"]),
-            "custo": float(row["CUSTO_UNIT_CALC"]),
-            "data": row["DATA"],
-        })
+def vendas_na_janela(matriz, desde, ate=None):
+    """Vendido por produto com data >= desde (e < ate, se informado), sem filtrar linhas.
 
-    for _, row in vendas.iterrows():
-        produto = str(row["PRODUTO"])
-        restante = float(row["QTD"])
-        lotes = estoque.get(produto, [])
-        while restante > 0 and lotes:
-            lote = lotes[0]
-            if lote["qtd"] <= restante:
-                restante -= lote["qtd"]
-                lotes.pop(0)
-            else:
-                lote["qtd"] -= restante
-                restante = 0
+    Exato para datas dentro do intervalo da matriz; fora dele o balde inteiro
+    antes/depois entra ou sai junto.
+    """
+    acum = matriz["acum"]
+    n_dias = acum.shape[1] - 3
 
-    today = pd.Timestamp.now().normalize()
-    registros = []
-    for produto, lotes in estoque.items():
-        for lote in lotes:
-            qtd = float(lote.get("qtd", 0))
-            if qtd <= 0:
-                continue
-            data_lote = lote.get("data")
-            dias = (today - data_lote.normalize()).days if pd.notna(data_lote) else pd.NA
-            custo_unit = float(lote.get("custo", 0))
-            registros.append({
-                "PRODUTO": produto,
-                "QTD_REMANESCENTE": qtd,
-                "DATA_LOTE": data_lote,
-                "CUSTO_UNIT": custo_unit,
-                "VALOR_LOTE": qtd * custo_unit,
-                "DIAS_PARADO_LOTE": dias,
-            })
+    def _coluna(dia):
+        k = (pd.Timestamp(dia).normalize() - matriz["dia0"]).days
+        return 0 if k < 0 else min(k, n_dias) + 1
+
+    fim = acum[:, -1] if ate is None else acum[:, _coluna(ate)]
+    return fim - acum[:, _coluna(desde)]
+
+
+def vendas_ultimos_dias(matriz, hoje, janelas=(30, 60, 90)):
+    """DataFrame por produto com V{dias} = vendido com data >= hoje - dias (futuras entram)."""
+    return pd.DataFrame(
+        {f"V{dias}": vendas_na_janela(matriz, hoje - pd.Timedelta(days=dias)) for dias in janelas},
+        index=pd.Index(matriz["produtos"], name="PRODUTO"),
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def matriz_vendas_diarias(_df_fifo, versao, hoje):
+    """montar_matriz_diaria do FIFO, uma vez por versão dos dados e por dia."""
+    return montar_matriz_diaria(_df_fifo, "QTD", hoje=hoje)
 
-    return pd.DataFrame(registros)
+
+@st.cache_data(show_spinner=False)
+def conferir_backends_fifo(_df_compras_raw: pd.DataFrame, _df_vendas_raw: pd.DataFrame, versao: str, tolerancia=0.005):
+    """Roda os dois motores FIFO e devolve (vendas divergentes, maior diferença em R$) no CUSTO_TOTAL."""
+    fifo_loop = calcular_fifo(_df_compras_raw, _df_vendas_raw, backend="loop")[0]
+    fifo_vet = calcular_fifo(_df_compras_raw, _df_vendas_raw, backend="vetorizado")[0]
+    if fifo_loop.empty or fifo_vet.empty:
+        return 0, 0.0
+    diff = (fifo_loop["CUSTO_TOTAL"] - fifo_vet["CUSTO_TOTAL"]).abs()
+    return int((diff > tolerancia).sum()), float(diff.max())
+
+
+# --------------------------------------------------
+# ATUALIZAÇÃO EM SEGUNDO PLANO (stale-while-revalidate)
+# --------------------------------------------------
+def _hoje_str():
+    return pd.Timestamp.now().strftime("%Y-%m-%d")
+
+
+@st.cache_resource
+def _estado_dados():
+    """Versão atual dos dados, compartilhada entre sessões e com a thread de atualização."""
+    return {
+        "lock": threading.Lock(),
+        "acordar": threading.Event(),
+        "dados": None,
+        "backends": {"loop"},
+        "thread": None,
+        "erro": None,
+        "atualizado_em": None,
+        "delta": None,
+    }
+
+
+def atualizar_dados(estado, em_fundo=False):
+    """Baixa/lê a planilha e já aquece base e FIFO; só então troca a versão de uma vez.
+
+    Se algo falhar no meio, a exceção sobe e a versão anterior continua valendo.
+    em_fundo=True (thread de atualização) não aquece o motor paralelo: subir
+    processos fica para o rerun de quem escolheu esse motor.
+    """
+    with estado["lock"]:
+        backends = sorted(b for b in estado["backends"] if not (em_fundo and b == "paralelo"))
+        anterior, delta = estado["dados"], estado["delta"]
+    conteudo, hash_planilha, _ = baixar_planilha()
+    dados = ler_planilha(conteudo, hash_planilha)
+    df_compras_raw, df_vendas_raw, versao = dados[:3]
+    if anterior is not None and anterior[2] != versao:
+        delta = {
+            "COMPRAS": detectar_delta(anterior[0], df_compras_raw),
+            "VENDAS": detectar_delta(anterior[1], df_vendas_raw),
+        }
+    compras, _, vendas = carregar_base(df_compras_raw, df_vendas_raw, versao)
+    for backend in backends:
+        calcular_tabelas_fifo(compras, vendas, versao, backend, _hoje_str(), _delta=delta)
+    with estado["lock"]:
+        estado["dados"] = dados
+        estado["delta"] = delta
+        estado["atualizado_em"] = pd.Timestamp.now()
+        estado["erro"] = None
+    return dados
+
+
+def _loop_atualizacao(estado, intervalo):
+    while True:
+        estado["acordar"].wait(intervalo)
+        estado["acordar"].clear()
+        try:
+            atualizar_dados(estado, em_fundo=True)
+        except Exception as e:
+            with estado["lock"]:
+                estado["erro"] = f"{type(e).__name__}: {e}"
+
+
+def carregar_dados(intervalo=INTERVALO_ATUALIZACAO):
+    """Última versão boa dos dados; só a primeira carga do processo espera o download.
+
+    Garante a thread que reconfere a planilha a cada `intervalo` segundos fora do
+    caminho do usuário.
+    """
+    estado = _estado_dados()
+    with estado["lock"]:
+        dados = estado["dados"]
+        if estado["thread"] is None or not estado["thread"].is_alive():
+            estado["thread"] = threading.Thread(
+                target=_loop_atualizacao, args=(estado, intervalo), daemon=True, name="atualiza-planilha"
+            )
+            estado["thread"].start()
+    if dados is None:
+        dados = atualizar_dados(estado)
+    return dados
 
 
 # --------------------------------------------------
 # CARREGAMENTO + BOTÃO ATUALIZAR
 # --------------------------------------------------
-col_btn, _ = st.columns([1, 4])
+col_btn, col_motor, _ = st.columns([1, 1, 3])
 with col_btn:
     if st.button("🔄 Atualizar dados da planilha"):
-        st.cache_data.clear()
-        st.rerun()
+        # Só o download é refeito; se a planilha não mudou, parse e FIFO saem do cache.
+        # Quem estiver usando o app segue na versão anterior até a troca.
+        try:
+            atualizar_dados(_estado_dados())
+        except ValueError as e:
+            st.error(str(e))
+            parar_rerun()
+        refazer_rerun()
+with col_motor:
+    with st.popover("⚙️ Motor FIFO"):
+        fifo_backend = st.radio(
+            "Motor de cálculo",
+            options=list(FIFO_BACKENDS.keys()),
+            format_func=lambda b: FIFO_BACKENDS[b],
+            key="fifo_backend",
+            help="Todos chegam no mesmo custo; vetorizado e paralelo aguentam históricos bem maiores.",
+        )
+        conferir_fifo = st.checkbox("Conferir com o loop", key="fifo_conferir")
+
+estado_dados = _estado_dados()
+with estado_dados["lock"]:
+    estado_dados["backends"].add(fifo_backend)  # a thread de fundo aquece esse motor também
 
-df_compras, df_vendas = carregar_dados()
-df_fifo, df_estoque = calcular_fifo(df_compras, df_vendas)
-df_lotes_fifo = calcular_lotes_remanescentes_fifo(df_compras, df_vendas)
+with medir_etapa("carregar_dados"):
+    try:
+        df_compras_raw, df_vendas_raw, versao_dados, leitura_planilha = carregar_dados()
+    except ValueError as e:
+        st.error(str(e))
+        parar_rerun()
+with col_btn:
+    _quando = estado_dados["atualizado_em"]
+    st.caption(
+        f"Planilha lida em {leitura_planilha['segundos']:.2f} s ({leitura_planilha['fonte']})"
+        + (f" · versão de {_quando:%H:%M}" if _quando is not None else "")
+    )
+    _delta = estado_dados["delta"]
+    if _delta is not None:
+        _novas = ", ".join(f"{aba} +{d['novas']}" for aba, d in _delta.items() if d["novas"])
+        if not delta_so_anexo(_delta):
+            st.caption("Última mudança alterou linhas antigas: FIFO recalculado do zero.")
+        elif _novas:
+            st.caption(f"Linhas novas na última atualização: {_novas}")
+    if estado_dados["erro"]:
+        st.caption(f"⚠️ Última atualização automática falhou: {estado_dados['erro']}")
+with medir_etapa("base canônica"):
+    df_compras, df_compras_entregues, df_vendas = carregar_base(df_compras_raw, df_vendas_raw, versao_dados)
+with medir_etapa(f"FIFO ({fifo_backend})"):
+    try:
+        df_fifo, df_estoque, df_lotes_fifo, estoque_atual_map = calcular_tabelas_fifo(
+            df_compras, df_vendas, versao_dados, fifo_backend, _hoje_str(), _delta=estado_dados["delta"]
+        )
+    except ValueError as e:
+        st.warning(str(e))
+        parar_rerun()
+with medir_etapa("matriz de vendas por dia"):
+    matriz_vendas = matriz_vendas_diarias(df_fifo, (versao_dados, fifo_backend), _hoje_str())
+
+if conferir_fifo:
+    with medir_etapa("FIFO conferência"):
+        divergentes, maior_diff = conferir_backends_fifo(df_compras, df_vendas, versao_dados)
+    if divergentes:
+        st.warning(f"Motores FIFO divergem em {divergentes} venda(s); maior diferença {format_reais(maior_diff)}.")
+    else:
+        st.caption(f"✅ Motores FIFO conferidos: mesmo CUSTO_TOTAL em todas as vendas (maior diferença {maior_diff:.6f}).")
 
 if df_fifo.empty:
     st.warning("Não foi possível calcular FIFO (sem vendas ou sem compras ENTREGUE válidas).")
-    st.stop()
+    parar_rerun()
 
 # -----------------------------
-# MAPA: ESTOQUE ATUAL POR PRODUTO
+# MAPA: ESTOQUE ATUAL POR PRODUTO (estoque_atual_map vem pronto de calcular_tabelas_fifo)
 # -----------------------------
-if not df_estoque.empty and ("PRODUTO" in df_estoque.columns) and ("SALDO_QTD" in df_estoque.columns):
-    estoque_atual_map = df_estoque.set_index("PRODUTO")["SALDO_QTD"].to_dict()
-else:
-    estoque_atual_map = {}
-
 def add_estoque_atual(df, col_produto="PRODUTO", nome_col="ESTOQUE_ATUAL"):
     out = df.copy()
     if col_produto in out.columns:
@@ -1415,61 +2314,6 @@ def _painel_resultado_text(row):
 
 
 
-def _nivel_confianca(row):
-    qtd = float(row.get("QTD_VENDIDA_TOTAL", 0) or 0)
-    v30 = float(row.get("V30", 0) or 0)
-    v60 = float(row.get("V60", 0) or 0)
-    intervalo = row.get("INTERVALO_ESPERADO")
-    lag = row.get("DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA")
-    sim = float(row.get("V30_SIMILARES", 0) or 0)
-    pontos = 0
-    if qtd >= 6:
-        pontos += 45
-    elif qtd >= 4:
-        pontos += 36
-    elif qtd >= 2:
-        pontos += 24
-    elif qtd >= 1:
-        pontos += 10
-    if v30 >= 3:
-        pontos += 25
-    elif v60 >= 4:
-        pontos += 18
-    elif v60 >= 2:
-        pontos += 10
-    if pd.notna(intervalo):
-        pontos += 15
-    if pd.notna(lag) and float(lag) >= 90:
-        pontos -= 18
-    elif pd.notna(lag) and float(lag) >= 60:
-        pontos -= 10
-    if qtd <= 1:
-        pontos -= 18
-    if qtd <= 1 and sim > 0:
-        pontos -= 8
-    pontos = max(0, min(100, int(round(pontos))))
-    if pontos >= 70:
-        return "Alta"
-    if pontos >= 45:
-        return "Média"
-    return "Baixa"
-
-
-def _risco_analise(row):
-    conf = _nivel_confianca(row)
-    qtd = float(row.get("QTD_VENDIDA_TOTAL", 0) or 0)
-    sim = float(row.get("V30_SIMILARES", 0) or 0)
-    if conf == "Alta":
-        risco = "Baixo"
-    elif conf == "Média":
-        risco = "Médio"
-    else:
-        risco = "Alto"
-    if qtd <= 1 and sim > 0:
-        risco = "Alto"
-    return risco
-
-
 def normalize_name(s):
     s = "" if s is None else str(s)
     s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("utf-8")
@@ -1486,42 +2330,275 @@ STOPWORDS_NOME = {
 }
 
 
-def tokenizar_produto(s):
-    s = normalize_name(s)
-    tokens = [t for t in s.split() if t and t not in STOPWORDS_NOME and not t.isdigit()]
-    return tokens
+def tokenizar_produto(s):
+    s = normalize_name(s)
+    tokens = [t for t in s.split() if t and t not in STOPWORDS_NOME and not t.isdigit()]
+    return tokens
+
+
+def montar_indice_similaridade(universo):
+    """Tokeniza cada nome uma vez e monta o índice invertido token -> posições.
+
+    Score entre dois nomes: Jaccard dos tokens + 0.15 se os 10 primeiros
+    caracteres normalizados batem (máx. 1.0); sem tokens, só nome normalizado
+    idêntico vale 1.0. Guarda também, por posição, o nº de tokens, o id do
+    prefixo de 10 letras e a ordem alfabética do nome, para pontuar os
+    candidatos de um produto em lote com numpy.
+    """
+    nomes = list(universo)
+    norm = [normalize_name(n) for n in nomes]
+    tokens = [frozenset(tokenizar_produto(n)) for n in nomes]
+    por_token, por_norm, prefixo_id = {}, {}, {}
+    for i, (toks, nn) in enumerate(zip(tokens, norm)):
+        for t in toks:
+            por_token.setdefault(t, []).append(i)
+        por_norm.setdefault(nn, []).append(i)
+        prefixo_id.setdefault(nn[:10], len(prefixo_id))
+    ordem = np.empty(len(nomes), dtype=np.int64)
+    ordem[sorted(range(len(nomes)), key=nomes.__getitem__)] = np.arange(len(nomes))
+    return {
+        "nomes": nomes,
+        "nomes_arr": np.array(nomes, dtype=object),
+        "norm": norm,
+        "tokens": tokens,
+        "n_tokens": np.array([len(t) for t in tokens], dtype=np.int64),
+        "por_token": {t: np.array(pos, dtype=np.int64) for t, pos in por_token.items()},
+        "por_norm": por_norm,
+        "prefixo_id": prefixo_id,
+        "prefixos": np.array([prefixo_id[nn[:10]] for nn in norm], dtype=np.int64),
+        "ordem": ordem,
+        "posicao": {n: i for i, n in enumerate(nomes)},
+    }
+
+
+def top_similares_indice(produto, indice, limite=3, min_score=0.34, candidatos=None):
+    """Os `limite` nomes mais parecidos com o produto (score >= min_score), do índice.
+
+    Só pontua quem divide token com o produto: sem token em comum o score máximo
+    é o bônus de prefixo (0.15); esses candidatos só entram quando min_score deixa. `candidatos` (posições, ex.: do MinHash)
+    restringe quem é pontuado; aí o resultado vira aproximado.
+    """
+    pos = indice["posicao"].get(produto)
+    if pos is not None:
+        ta, na = indice["tokens"][pos], indice["norm"][pos]
+    else:
+        ta, na = frozenset(tokenizar_produto(produto)), normalize_name(produto)
+    n = len(indice["nomes"])
+
+    if not ta:
+        # sem token: só nome normalizado idêntico (e não vazio) pontua 1.0; o resto é 0.0
+        iguais = set(indice["por_norm"].get(na, [])) if na else set()
+        candidatos = range(n) if min_score <= 0 else sorted(iguais)
+        sims = [(indice["nomes"][j], 1.0 if j in iguais else 0.0) for j in candidatos if indice["nomes"][j] != produto]
+        sims = [(nome, score) for nome, score in sims if score >= min_score]
+        sims.sort(key=lambda x: (-x[1], x[0]))
+        return sims[:limite]
+
+    postings = [indice["por_token"][t] for t in ta if t in indice["por_token"]]
+    inter = np.bincount(np.concatenate(postings), minlength=n) if postings else np.zeros(n, dtype=np.int64)
+    mesmo_prefixo = indice["prefixos"] == indice["prefixo_id"].get(na[:10], -1)
+    if candidatos is not None:
+        cand = np.asarray(candidatos, dtype=np.int64)
+    elif min_score <= 0:
+        cand = np.arange(n)
+    elif min_score <= 0.15:
+        cand = np.flatnonzero((inter > 0) | mesmo_prefixo)
+    else:
+        cand = np.flatnonzero(inter > 0)
+    cand = cand[indice["nomes_arr"][cand] != produto]
+
+    n_tb = indice["n_tokens"][cand]
+    inter_c = inter[cand]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jacc = inter_c / (len(ta) + n_tb - inter_c)
+    score = np.minimum(1.0, jacc + np.where(mesmo_prefixo[cand], 0.15, 0.0))
+    score = np.where(n_tb > 0, score, 0.0)  # outro sem token: nomes não podem ser iguais
+
+    ok = score >= min_score
+    cand, score = cand[ok], score[ok]
+    top = np.lexsort((indice["ordem"][cand], -score))[:limite]
+    return [(indice["nomes"][j], float(sc)) for j, sc in zip(cand[top], score[top])]
+
+
+_PRIMO_MINHASH = (1 << 31) - 1
+
+
+def _hash_token(t):
+    return int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "little") % _PRIMO_MINHASH
+
+
+def montar_minhash(indice, bandas=MINHASH_BANDAS, linhas_por_banda=MINHASH_LINHAS_POR_BANDA, semente=7):
+    """Assinaturas MinHash dos tokens de cada nome + baldes LSH por banda.
+
+    Dois nomes caem no mesmo balde de uma banda quando as `linhas_por_banda`
+    mínimas batem; com Jaccard s a chance de virar candidato é 1-(1-s^r)^b.
+    Mais bandas (ou menos linhas) = mais recall e mais candidatos para pontuar.
+    """
+    n_hash = bandas * linhas_por_banda
+    rng = np.random.default_rng(semente)
+    a = rng.integers(1, _PRIMO_MINHASH, n_hash, dtype=np.uint64)
+    b = rng.integers(0, _PRIMO_MINHASH, n_hash, dtype=np.uint64)
+    hashes_token = {t: _hash_token(t) for t in indice["por_token"]}
+
+    assinaturas = np.full((len(indice["nomes"]), n_hash), _PRIMO_MINHASH, dtype=np.uint64)
+    for i, toks in enumerate(indice["tokens"]):
+        if toks:
+            h = np.fromiter((hashes_token[t] for t in toks), dtype=np.uint64, count=len(toks))
+            assinaturas[i] = ((np.outer(h, a) + b) % _PRIMO_MINHASH).min(axis=0)
+
+    baldes = []
+    for k in range(bandas):
+        faixa = np.ascontiguousarray(assinaturas[:, k * linhas_por_banda:(k + 1) * linhas_por_banda])
+        chaves = faixa.view(np.dtype((np.void, faixa.dtype.itemsize * linhas_por_banda))).ravel()
+        balde = {}
+        for i, chave in enumerate(chaves):
+            if indice["tokens"][i]:
+                balde.setdefault(chave.tobytes(), []).append(i)
+        baldes.append(balde)
+    return {"assinaturas": assinaturas, "baldes": baldes, "linhas_por_banda": linhas_por_banda}
+
+
+def top_similares_minhash(produto, indice, minhash, limite=3, min_score=0.34):
+    """top_similares_indice aproximado: só pontua quem divide algum balde LSH com o produto."""
+    pos = indice["posicao"].get(produto)
+    if pos is None or not indice["tokens"][pos]:
+        return top_similares_indice(produto, indice, limite=limite, min_score=min_score)
+    r = minhash["linhas_por_banda"]
+    assinatura = minhash["assinaturas"][pos]
+    candidatos = set()
+    for k, balde in enumerate(minhash["baldes"]):
+        candidatos.update(balde.get(assinatura[k * r:(k + 1) * r].tobytes(), ()))
+    return top_similares_indice(produto, indice, limite=limite, min_score=min_score, candidatos=sorted(candidatos))
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def vizinhos_similares(produtos: tuple, limite=3, min_score=0.34, modo="auto"):
+    """Lista de similares de cada produto do catálogo (guardada por catálogo).
+
+    modo "exato" usa o índice invertido; "minhash" usa LSH (aproximado, para
+    catálogos enormes); "auto" troca para MinHash acima de SIMILARIDADE_LIMITE_LSH.
+    """
+    indice = montar_indice_similaridade(produtos)
+    if modo == "minhash" or (modo == "auto" and len(produtos) > SIMILARIDADE_LIMITE_LSH):
+        minhash = montar_minhash(indice)
+        return {p: top_similares_minhash(p, indice, minhash, limite=limite, min_score=min_score) for p in produtos}
+    return {p: top_similares_indice(p, indice, limite=limite, min_score=min_score) for p in produtos}
+
+
+def medir_recall_minhash(produtos, limite=3, min_score=0.34, amostra=200, bandas=MINHASH_BANDAS,
+                         linhas_por_banda=MINHASH_LINHAS_POR_BANDA, semente=0):
+    """Compara o MinHash com a busca exata numa amostra de produtos.
+
+    A referência é o top_similares_indice (busca exata). Recall = fração dos
+    vizinhos exatos que o MinHash achou.
+    """
+    produtos = list(produtos)
+    indice = montar_indice_similaridade(produtos)
+    inicio = time.perf_counter()
+    minhash = montar_minhash(indice, bandas=bandas, linhas_por_banda=linhas_por_banda)
+    tempo_montagem = time.perf_counter() - inicio
+
+    rng = np.random.default_rng(semente)
+    consulta = [produtos[i] for i in rng.choice(len(produtos), size=min(amostra, len(produtos)), replace=False)]
+    achados = esperados = 0
+    tempo_exato = tempo_lsh = 0.0
+    for p in consulta:
+        inicio = time.perf_counter()
+        exato = top_similares_indice(p, indice, limite=limite, min_score=min_score)
+        tempo_exato += time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        aprox = top_similares_minhash(p, indice, minhash, limite=limite, min_score=min_score)
+        tempo_lsh += time.perf_counter() - inicio
+        nomes_aprox = {nome for nome, _ in aprox}
+        esperados += len(exato)
+        achados += sum(1 for nome, _ in exato if nome in nomes_aprox)
+    return {
+        "produtos": len(produtos),
+        "consultas": len(consulta),
+        "bandas": bandas,
+        "linhas_por_banda": linhas_por_banda,
+        "recall": achados / esperados if esperados else 1.0,
+        "ms_por_consulta_exato": 1000 * tempo_exato / max(1, len(consulta)),
+        "ms_por_consulta_minhash": 1000 * tempo_lsh / max(1, len(consulta)),
+        "s_montagem_minhash": tempo_montagem,
+    }
+
+
+def _hash_catalogo(produtos):
+    return hashlib.sha1("\n".join(sorted(produtos)).encode("utf-8")).hexdigest()
+
+
+def _ler_grafo(caminho):
+    try:
+        with open(caminho, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def atualizar_grafo_similares(produtos, limite=GRAFO_VIZINHOS, min_score=GRAFO_MIN_SCORE, caminho=GRAFO_SIMILARES, modo="auto"):
+    """Devolve (grafo produto -> [(similar, score)], origem) lendo/gravando o grafo em disco.
+
+    O grafo só depende do conjunto de nomes, então fica salvo com o hash desse
+    conjunto. Se o catálogo mudou pouco, recalcula só quem pode ter mudado:
+    os produtos novos, quem tinha um removido na lista e quem passaria a ter um
+    novo no top (o score é simétrico). O resultado é o mesmo da montagem do zero.
+    """
+    produtos = sorted(set(produtos))
+    chave = _hash_catalogo(produtos)
+    salvo = _ler_grafo(caminho)
+    compativel = isinstance(salvo, dict) and salvo.get("limite") == limite and salvo.get("min_score") == min_score
+    if compativel and salvo.get("hash") == chave:
+        return salvo["vizinhos"], "disco"
+
+    atuais = set(produtos)
+    antigos = set(salvo["vizinhos"]) if compativel else set()
+    novos, removidos = atuais - antigos, antigos - atuais
+    if compativel and len(novos) + len(removidos) <= max(50, len(produtos) // 5):
+        indice = montar_indice_similaridade(produtos)
+        afetados = set(novos)
+        for p, viz in salvo["vizinhos"].items():
+            if p in atuais and any(nome in removidos for nome, _ in viz):
+                afetados.add(p)
+        for p in novos:
+            for nome, score in top_similares_indice(p, indice, limite=len(produtos), min_score=min_score):
+                viz = salvo["vizinhos"].get(nome)
+                # só muda a lista de quem o novo produto entraria no top
+                if viz is None or len(viz) < limite or (-score, p) < (-viz[-1][1], viz[-1][0]):
+                    afetados.add(nome)
+        minhash = montar_minhash(indice) if modo == "minhash" or (modo == "auto" and len(produtos) > SIMILARIDADE_LIMITE_LSH) else None
+        vizinhos = {p: v for p, v in salvo["vizinhos"].items() if p in atuais}
+        for p in afetados:
+            if minhash is not None:
+                vizinhos[p] = top_similares_minhash(p, indice, minhash, limite=limite, min_score=min_score)
+            else:
+                vizinhos[p] = top_similares_indice(p, indice, limite=limite, min_score=min_score)
+        origem = f"incremental (+{len(novos)} / -{len(removidos)} produtos, {len(afetados)} recalculados)"
+    else:
+        vizinhos = dict(vizinhos_similares(tuple(produtos), limite=limite, min_score=min_score, modo=modo))
+        origem = "montado do zero"
+
+    try:
+        _gravar_atomico(caminho, pickle.dumps(
+            {"hash": chave, "limite": limite, "min_score": min_score, "vizinhos": vizinhos},
+            protocol=pickle.HIGHEST_PROTOCOL,
+        ))
+    except Exception:
+        pass
+    return vizinhos, origem
 
 
-def similaridade_produto(a, b):
-    ta = set(tokenizar_produto(a))
-    tb = set(tokenizar_produto(b))
-    if not ta or not tb:
-        na, nb = normalize_name(a), normalize_name(b)
-        if not na or not nb:
-            return 0.0
-        return 1.0 if na == nb else 0.0
-    inter = len(ta & tb)
-    union = len(ta | tb)
-    jacc = inter / union if union else 0.0
-    prefix_bonus = 0.15 if normalize_name(a)[:10] == normalize_name(b)[:10] else 0.0
-    return min(1.0, jacc + prefix_bonus)
-
-
-def top_similares(produto, universo, limite=3, min_score=0.34):
-    sims = []
-    for other in universo:
-        if other == produto:
-            continue
-        score = similaridade_produto(produto, other)
-        if score >= min_score:
-            sims.append((other, score))
-    sims.sort(key=lambda x: (-x[1], x[0]))
-    return sims[:limite]
+@st.cache_data(show_spinner=False, max_entries=4)
+def grafo_similares(produtos: tuple):
+    """Grafo de similares do catálogo; o disco evita remontar entre sessões."""
+    return atualizar_grafo_similares(produtos)[0]
 
 
 def _score_busca_produto(produto, consulta):
-    produto_norm = normalize_name(produto)
-    consulta_norm = normalize_name(consulta)
+    return _score_busca_norm(normalize_name(produto), normalize_name(consulta))
+
+
+def _score_busca_norm(produto_norm, consulta_norm):
     if not consulta_norm:
         return 0.0
 
@@ -1606,6 +2683,128 @@ def buscar_produtos_relacionados(consulta, produtos, estoque_map, limite=80):
         ascending=[False, False, False, True]
     ).head(limite).reset_index(drop=True)
     return df_res
+_ALFABETO_BUSCA = "abcdefghijklmnopqrstuvwxyz0123456789 "
+
+
+def montar_indice_busca(produtos, estoque_map):
+    """Índice da busca de produtos: nomes normalizados, tokens, n-gramas e estoque.
+
+    Guarda, por posição do produto, o nome normalizado, a contagem de cada
+    caractere (limite superior do SequenceMatcher) e as postings de todo
+    pedaço de 1 a 3 letras dentro de cada token, para achar candidatos sem
+    varrer o catálogo.
+    """
+    produtos = list(produtos or [])
+    nomes = ["" if p is None else str(p) for p in produtos]
+    norm = [normalize_name(n) for n in nomes]
+    postings = {}
+    for i, nn in enumerate(norm):
+        gramas = set()
+        for tok in nn.split():
+            for k in (1, 2, 3):
+                gramas.update(tok[j:j + k] for j in range(len(tok) - k + 1))
+        for g in gramas:
+            postings.setdefault(g, []).append(i)
+    contagem = np.zeros((len(norm), len(_ALFABETO_BUSCA)), dtype=np.int32)
+    if norm:
+        cod = {c: k for k, c in enumerate(_ALFABETO_BUSCA)}
+        for i, nn in enumerate(norm):
+            for c in nn:
+                contagem[i, cod[c]] += 1
+    estoque = np.array([float(estoque_map.get(p, 0) or 0) for p in produtos], dtype=float)
+    return {
+        "produtos": produtos,
+        "nomes": nomes,
+        "norm": norm,
+        "tem_token": np.array([bool(nn.split()) for nn in norm], dtype=bool),
+        "postings": {g: np.array(pos, dtype=np.int64) for g, pos in postings.items()},
+        "contagem": contagem,
+        "tamanho": np.array([len(nn) for nn in norm], dtype=np.int64),
+        "estoque": estoque,
+    }
+
+
+def _com_token_contendo(indice, termo):
+    """Posições cujo nome tem algum token que contém `termo` (candidatos exatos)."""
+    if len(termo) <= 3:
+        return indice["postings"].get(termo, np.zeros(0, dtype=np.int64))
+    cand = None
+    for j in range(len(termo) - 2):
+        pos = indice["postings"].get(termo[j:j + 3])
+        if pos is None:
+            return np.zeros(0, dtype=np.int64)
+        cand = pos if cand is None else np.intersect1d(cand, pos, assume_unique=True)
+    return np.array([i for i in cand if any(termo in tok for tok in indice["norm"][i].split())], dtype=np.int64)
+
+
+def buscar_produtos_indice(consulta, indice, limite=80):
+    """Mesmo resultado do buscar_produtos_relacionados, pontuando só candidatos.
+
+    Quem não divide nenhum pedaço de token com a consulta só pontua pelo
+    SequenceMatcher (até 35); esses entram só se o limite superior da razão
+    (contagem de caracteres em comum) ainda alcança o corte de 18.
+    """
+    consulta_txt = "" if consulta is None else str(consulta).strip()
+    busca_exata = len(consulta_txt) >= 2 and consulta_txt.startswith('"') and consulta_txt.endswith('"')
+    consulta_core = consulta_txt[1:-1].strip() if busca_exata else consulta_txt
+    consulta_norm = normalize_name(consulta_core)
+    n = len(indice["produtos"])
+    norm, estoque = indice["norm"], indice["estoque"]
+    tokens_consulta = consulta_norm.split()
+
+    if not consulta_norm:
+        posicoes = np.arange(n)
+        scores = np.zeros(n)
+    elif busca_exata:
+        cand = None
+        for t in tokens_consulta:
+            pos = _com_token_contendo(indice, t)
+            cand = pos if cand is None else np.intersect1d(cand, pos, assume_unique=True)
+        posicoes = np.array([i for i in cand if consulta_norm in norm[i]], dtype=np.int64)
+        scores = np.array([1025.0 if norm[i].startswith(consulta_norm) else 1000.0 for i in posicoes])
+    else:
+        por_token = [_com_token_contendo(indice, t) for t in tokens_consulta]
+        com_token = np.unique(np.concatenate(por_token)) if por_token else np.zeros(0, dtype=np.int64)
+        q = np.zeros(len(_ALFABETO_BUSCA), dtype=np.int32)
+        for c in consulta_norm:
+            q[_ALFABETO_BUSCA.index(c)] += 1
+        comuns = np.minimum(indice["contagem"], q).sum(axis=1)
+        teto = 35.0 * 2.0 * comuns / np.maximum(indice["tamanho"] + len(consulta_norm), 1)
+        pelo_texto = np.flatnonzero(teto >= 18 - 1e-9)
+        cand = np.union1d(com_token, pelo_texto)
+        cand = cand[indice["tem_token"][cand]]
+        scores = np.array([_score_busca_norm(norm[i], consulta_norm) for i in cand])
+        manter = scores >= 18
+        posicoes, scores = cand[manter], scores[manter]
+
+    if not len(posicoes) and consulta_norm and not busca_exata:
+        posicoes = np.arange(n)
+        scores = np.array([SequenceMatcher(None, consulta_norm, nn).ratio() * 35 for nn in norm])
+        nomes = [indice["produtos"][i] for i in posicoes]
+    else:
+        nomes = [indice["nomes"][i] for i in posicoes]
+
+    if not len(posicoes):
+        return pd.DataFrame()
+    est = estoque[posicoes]
+    df_res = pd.DataFrame({
+        'PRODUTO': nomes,
+        'ESTOQUE': est,
+        'TEM_ESTOQUE': np.where(est > 0, 1, 0),
+        'SCORE': np.asarray(scores, dtype=float),
+    })
+    return df_res.sort_values(
+        ['TEM_ESTOQUE', 'SCORE', 'ESTOQUE', 'PRODUTO'],
+        ascending=[False, False, False, True]
+    ).head(limite).reset_index(drop=True)
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def indice_busca(_produtos, _estoque_map, versao):
+    """montar_indice_busca uma vez por versão dos dados."""
+    return montar_indice_busca(_produtos, _estoque_map)
+
+
 def label_produto_busca(produto, estoque_map):
     estoque = float(estoque_map.get(produto, 0) or 0)
     status = 'com estoque' if estoque > 0 else 'sem estoque'
@@ -1676,100 +2875,134 @@ def enriquecer_vendas_com_giro_parado(df_sales: pd.DataFrame, df_compras_raw: pd
     return out.drop(columns=["PRODUTO_KEY"], errors="ignore")
 
 
-def _media_intervalo_em_dias(df_vendas_prod):
-    if df_vendas_prod is None or df_vendas_prod.empty or "DATA" not in df_vendas_prod.columns:
-        return np.nan
-    datas = (
-        pd.to_datetime(df_vendas_prod["DATA"], errors="coerce")
-        .dropna()
-        .sort_values()
-        .dt.normalize()
-        .drop_duplicates()
-    )
-    if len(datas) <= 1:
-        return np.nan
-    diffs = datas.diff().dt.days.dropna()
-    if diffs.empty:
-        return np.nan
-    return float(diffs.mean())
-
-
-def _dias_entre_compra_e_venda(c_df, v_df):
-    """Mede quanto tempo o item levou para começar a girar.
-    Para cada compra, procura a primeira venda no mesmo dia ou depois.
-    Retorna média e mediana em dias, quando existir histórico suficiente.
+def _dias_inteiros(df):
+    """PRODUTO e DATA normalizada em dias inteiros, sem linhas vazias."""
+    d = pd.DataFrame({"PRODUTO": df["PRODUTO"], "DIA": df["DATA"].dt.normalize()}).dropna()
+    return d["PRODUTO"].to_numpy(dtype=object), d["DIA"].to_numpy(dtype="datetime64[D]").astype(np.int64)
+
+
+def lag_compra_venda(df_compras, df_vendas):
+    """Mede quanto tempo cada compra levou para começar a girar, para todos os produtos.
+
+    Para cada compra, acha a primeira venda do mesmo produto no mesmo dia ou
+    depois com um searchsorted só (chave = produto + dia). Devolve
+    (por_produto, por_lote): média, mediana, p25 e p75 em dias por produto, e
+    o lag de cada compra que chegou a vender.
     """
-    if c_df is None or v_df is None or c_df.empty or v_df.empty or "DATA" not in c_df.columns or "DATA" not in v_df.columns:
-        return np.nan, np.nan
+    prod_c, dia_c = _dias_inteiros(df_compras)
+    prod_v, dia_v = _dias_inteiros(df_vendas)
+    colunas = ["MEDIA", "MEDIANA", "P25", "P75"]
+    vazio = pd.DataFrame(columns=colunas, index=pd.Index([], name="PRODUTO"), dtype=float)
+    if not len(dia_c) or not len(dia_v):
+        return vazio, pd.DataFrame({"PRODUTO": [], "DIA_COMPRA": [], "DIAS_ATE_VENDER": []})
+
+    codigos, _ = pd.factorize(np.concatenate([prod_c, prod_v]))
+    cod_c, cod_v = codigos[:len(dia_c)], codigos[len(dia_c):]
+    base = min(dia_c.min(), dia_v.min())
+    span = max(dia_c.max(), dia_v.max()) - base + 1
+    chave_c = cod_c * span + (dia_c - base)
+    chave_v = cod_v * span + (dia_v - base)
+    ordem = np.argsort(chave_v, kind="stable")
+    chave_v, cod_v, dia_v = chave_v[ordem], cod_v[ordem], dia_v[ordem]
+
+    pos = np.searchsorted(chave_v, chave_c, side="left")
+    achou = pos < len(chave_v)
+    achou[achou] = cod_v[pos[achou]] == cod_c[achou]
+    por_lote = pd.DataFrame({
+        "PRODUTO": prod_c[achou],
+        "DIA_COMPRA": dia_c[achou].astype("datetime64[D]"),
+        "DIAS_ATE_VENDER": dia_v[pos[achou]] - dia_c[achou],
+    })
+    if por_lote.empty:
+        return vazio, por_lote
+    g = por_lote.groupby("PRODUTO", sort=False)["DIAS_ATE_VENDER"]
+    por_produto = pd.DataFrame({
+        "MEDIA": g.mean(),
+        "MEDIANA": g.median(),
+        "P25": g.quantile(0.25),
+        "P75": g.quantile(0.75),
+    })
+    return por_produto, por_lote
+
 
-    compras_datas = pd.to_datetime(c_df["DATA"], errors="coerce").dropna().sort_values().dt.normalize().tolist()
-    vendas_datas = pd.to_datetime(v_df["DATA"], errors="coerce").dropna().sort_values().dt.normalize().tolist()
-    if not compras_datas or not vendas_datas:
-        return np.nan, np.nan
+def _intervalo_medio_por_produto(df):
+    """Média de dias entre datas distintas de venda, por produto (NaN com menos de 2 datas)."""
+    datas = pd.DataFrame({"PRODUTO": df["PRODUTO"], "DIA": df["DATA"].dt.normalize()}).dropna(subset=["DIA"])
+    datas = datas.drop_duplicates().sort_values(["PRODUTO", "DIA"], kind="stable")
+    gaps = datas.groupby("PRODUTO", sort=False)["DIA"].diff().dt.days
+    return gaps.groupby(datas["PRODUTO"], sort=False).mean()
 
-    diffs = []
-    for dc in compras_datas:
-        prox_venda = next((dv for dv in vendas_datas if dv >= dc), None)
-        if prox_venda is not None:
-            diffs.append((prox_venda - dc).days)
 
-    if not diffs:
-        return np.nan, np.nan
-    return float(np.mean(diffs)), float(np.median(diffs))
+def _agregados_por_produto(df, col_qtd):
+    """Soma e primeira/última data por produto, num groupby só."""
+    g = pd.DataFrame({"PRODUTO": df["PRODUTO"], "DATA": df["DATA"], "QTD": df[col_qtd]})
+    out = g.groupby("PRODUTO", sort=False).agg({"QTD": "sum", "DATA": ["min", "max"]})
+    out.columns = ["QTD", "PRIMEIRA", "ULTIMA"]
+    return out
 
 
-def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
+def build_reposicao_inteligente(df_fifo, df_estoque, df_compras, matriz_vendas=None):
     produtos = sorted(set(df_fifo.get("PRODUTO", pd.Series(dtype=str)).dropna().astype(str).tolist()) |
                       set(df_estoque.get("PRODUTO", pd.Series(dtype=str)).dropna().astype(str).tolist()) |
                       set(df_compras.get("PRODUTO", pd.Series(dtype=str)).dropna().astype(str).tolist()))
     if not produtos:
         return pd.DataFrame()
 
-    fifo = df_fifo.copy()
-    fifo = ensure_datetime_series(fifo, "DATA")
-    fifo["QTD"] = fifo.get("QTD", 0).apply(parse_money).astype(float)
-    fifo["VALOR_TOTAL"] = fifo.get("VALOR_TOTAL", 0).apply(parse_money).astype(float)
-    fifo["CUSTO_TOTAL"] = fifo.get("CUSTO_TOTAL", 0).apply(parse_money).astype(float)
-    fifo["LUCRO"] = fifo.get("LUCRO", 0).apply(parse_money).astype(float)
-
-    compras = df_compras.copy()
-    compras.columns = [str(c).strip().upper() for c in compras.columns]
-    compras = ensure_datetime_series(compras, "DATA")
-    if "STATUS" in compras.columns:
-        compras = compras[compras["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
-    compras["QUANTIDADE"] = compras.get("QUANTIDADE", 0).apply(parse_money).astype(float)
-    compras["CUSTO UNITÁRIO"] = compras.get("CUSTO UNITÁRIO", 0).apply(parse_money).astype(float)
-    compras["CUSTO_TOTAL"] = compras["QUANTIDADE"] * compras["CUSTO UNITÁRIO"]
-
-    estoque = df_estoque.copy() if isinstance(df_estoque, pd.DataFrame) else pd.DataFrame()
-    if not estoque.empty:
-        estoque["SALDO_QTD"] = estoque.get("SALDO_QTD", 0).apply(parse_money).astype(float)
-        estoque["VALOR_ESTOQUE"] = estoque.get("VALOR_ESTOQUE", 0).apply(parse_money).astype(float)
-        estoque["CUSTO_MEDIO_FIFO"] = estoque.get("CUSTO_MEDIO_FIFO", 0).apply(parse_money).astype(float)
+    # df_fifo e df_estoque saem tipados do calcular_fifo; compras vem da base canônica.
+    fifo = _linhas_com_produto_texto(df_fifo)
+    compras = _linhas_com_produto_texto(filtrar_entregues(df_compras))
+    estoque = df_estoque if isinstance(df_estoque, pd.DataFrame) else pd.DataFrame()
+    estoque = _linhas_com_produto_texto(estoque).drop_duplicates("PRODUTO", keep="first")
+    if not estoque.empty and not {"SALDO_QTD", "VALOR_ESTOQUE", "CUSTO_MEDIO_FIFO"} <= set(estoque.columns):
+        estoque = estoque.iloc[0:0]
 
     hoje = pd.Timestamp.now().normalize()
     linhas = []
 
-    for prod in produtos:
-        v = fifo[fifo["PRODUTO"] == prod].copy()
-        c = compras[compras["PRODUTO"] == prod].copy() if "PRODUTO" in compras.columns else pd.DataFrame()
-        e = estoque[estoque["PRODUTO"] == prod].copy() if not estoque.empty and "PRODUTO" in estoque.columns else pd.DataFrame()
-
-        estoque_atual = float(e["SALDO_QTD"].iloc[0]) if not e.empty else 0.0
-        valor_estoque = float(e["VALOR_ESTOQUE"].iloc[0]) if not e.empty else 0.0
-        custo_fifo = float(e["CUSTO_MEDIO_FIFO"].iloc[0]) if not e.empty else 0.0
-
-        qtd_vendida = float(v["QTD"].sum()) if not v.empty else 0.0
-        receita_total = float(v["VALOR_TOTAL"].sum()) if not v.empty else 0.0
-        lucro_total = float(v["LUCRO"].sum()) if not v.empty else 0.0
-        qtd_comprada = float(c["QUANTIDADE"].sum()) if not c.empty else 0.0
+    # Tudo que antes era filtro por produto (fifo[fifo.PRODUTO == prod]) sai de um groupby só.
+    agg_v = _agregados_por_produto(fifo, "QTD")
+    if matriz_vendas is None:
+        matriz_vendas = montar_matriz_diaria(fifo, "QTD", hoje=hoje)
+    agg_v = agg_v.join(vendas_ultimos_dias(matriz_vendas, hoje))
+    agg_v["RECEITA"] = fifo.groupby("PRODUTO", sort=False)["VALOR_TOTAL"].sum()
+    agg_v["LUCRO"] = fifo.groupby("PRODUTO", sort=False)["LUCRO"].sum()
+    agg_v["INTERVALO"] = _intervalo_medio_por_produto(fifo)
+    agg_c = _agregados_por_produto(compras, "QUANTIDADE")
+    vizinhos = grafo_similares(tuple(produtos))
+    lag = lag_compra_venda(compras, fifo)[0].to_dict("index")
+    # custo unitário da última compra ENTREGUE: vale para quem não tem lote aberto (custo FIFO 0)
+    ult_custo = {}
+    if "CUSTO UNITÁRIO" in compras.columns:
+        custo_unit = pd.to_numeric(compras["CUSTO UNITÁRIO"], errors="coerce")
+        com_custo = compras[(custo_unit > 0) & (custo_unit <= CUSTO_MAX_PLAUSIVEL)]
+        ult_custo = com_custo.sort_values("DATA", kind="stable", na_position="first").groupby("PRODUTO", sort=False)["CUSTO UNITÁRIO"].last().to_dict()
+    est = estoque.set_index("PRODUTO")[["SALDO_QTD", "VALOR_ESTOQUE", "CUSTO_MEDIO_FIFO"]].to_dict("index") if not estoque.empty else {}
+    ven = agg_v.to_dict("index")
+    com = agg_c.to_dict("index")
 
-        primeira_venda = v["DATA"].min() if not v.empty else pd.NaT
-        ultima_venda = v["DATA"].max() if not v.empty else pd.NaT
-        primeira_compra = c["DATA"].min() if not c.empty else pd.NaT
-        ultima_compra = c["DATA"].max() if not c.empty else pd.NaT
-
-        media_dias_compra_venda, mediana_dias_compra_venda = _dias_entre_compra_e_venda(c, v)
+    for prod in produtos:
+        v = ven.get(prod)
+        c = com.get(prod)
+        e = est.get(prod)
+
+        estoque_atual = float(e["SALDO_QTD"]) if e else 0.0
+        valor_estoque = float(e["VALOR_ESTOQUE"]) if e else 0.0
+        custo_fifo = float(e["CUSTO_MEDIO_FIFO"]) if e else 0.0
+        custo_reposicao = custo_fifo if custo_fifo > 0 else float(ult_custo.get(prod, 0.0))
+
+        qtd_vendida = float(v["QTD"]) if v else 0.0
+        receita_total = float(v["RECEITA"]) if v else 0.0
+        lucro_total = float(v["LUCRO"]) if v else 0.0
+        qtd_comprada = float(c["QTD"]) if c else 0.0
+
+        primeira_venda = v["PRIMEIRA"] if v else pd.NaT
+        ultima_venda = v["ULTIMA"] if v else pd.NaT
+        primeira_compra = c["PRIMEIRA"] if c else pd.NaT
+        ultima_compra = c["ULTIMA"] if c else pd.NaT
+
+        lg = lag.get(prod)
+        media_dias_compra_venda = lg["MEDIA"] if lg else np.nan
+        mediana_dias_compra_venda = lg["MEDIANA"] if lg else np.nan
         dias_primeira_compra_ate_primeira_venda = int((primeira_venda.normalize() - primeira_compra.normalize()).days) if pd.notna(primeira_compra) and pd.notna(primeira_venda) and primeira_venda >= primeira_compra else np.nan
         dias_ultima_compra_ate_ultima_venda = int((ultima_venda.normalize() - ultima_compra.normalize()).days) if pd.notna(ultima_compra) and pd.notna(ultima_venda) and ultima_venda >= ultima_compra else np.nan
 
@@ -1777,15 +3010,15 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
         dias_desde_ult_venda = max(0, int((hoje - ultima_venda.normalize()).days)) if pd.notna(ultima_venda) else 9999
         dias_desde_ult_compra = max(0, int((hoje - ultima_compra.normalize()).days)) if pd.notna(ultima_compra) else 9999
 
-        v30 = v[v["DATA"] >= (hoje - pd.Timedelta(days=30))]["QTD"].sum() if not v.empty else 0.0
-        v60 = v[v["DATA"] >= (hoje - pd.Timedelta(days=60))]["QTD"].sum() if not v.empty else 0.0
-        v90 = v[v["DATA"] >= (hoje - pd.Timedelta(days=90))]["QTD"].sum() if not v.empty else 0.0
+        v30 = v["V30"] if v else 0.0
+        v60 = v["V60"] if v else 0.0
+        v90 = v["V90"] if v else 0.0
 
         vel_30 = v30 / 30.0
         vel_60 = v60 / 60.0
         vel_90 = v90 / 90.0
         vel_hist = qtd_vendida / dias_com_historico if dias_com_historico else 0.0
-        intervalo_medio_vendas = _media_intervalo_em_dias(v)
+        intervalo_medio_vendas = float(v["INTERVALO"]) if v and pd.notna(v["INTERVALO"]) else np.nan
         intervalo_esperado = float(intervalo_medio_vendas) if pd.notna(intervalo_medio_vendas) else np.nan
 
         velocidade_base = (vel_30 * 0.50) + (vel_60 * 0.22) + (vel_90 * 0.13) + (vel_hist * 0.15)
@@ -1807,7 +3040,7 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
             elif dias_desde_ult_venda > 45:
                 fator_recencia = 0.65
 
-        similares = top_similares(prod, produtos, limite=3, min_score=0.34)
+        similares = vizinhos.get(prod, [])[:3]
         similares_txt = ", ".join([f"{nome} ({score:.0%})" for nome, score in similares])
         boost_similares = 0.0
         ultima_venda_similar = pd.NaT
@@ -1816,23 +3049,23 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
         v30_similares = 0.0
 
         for nome, score in similares:
-            vv = fifo[fifo["PRODUTO"] == nome].copy()
-            cc = compras[compras["PRODUTO"] == nome].copy() if "PRODUTO" in compras.columns else pd.DataFrame()
-            if not vv.empty:
-                vv30 = vv[vv["DATA"] >= (hoje - pd.Timedelta(days=30))]["QTD"].sum() / 30.0
+            vv = ven.get(nome)
+            cc = com.get(nome)
+            if vv:
+                vv30 = vv["V30"] / 30.0
                 boost_similares += vv30 * score
-                v30_similares += vv[vv["DATA"] >= (hoje - pd.Timedelta(days=30))]["QTD"].sum() * score
-                cand_ult_venda = vv["DATA"].max()
+                v30_similares += vv["V30"] * score
+                cand_ult_venda = vv["ULTIMA"]
                 if pd.notna(cand_ult_venda) and (pd.isna(ultima_venda_similar) or cand_ult_venda > ultima_venda_similar):
                     ultima_venda_similar = cand_ult_venda
-                cand_intervalo = _media_intervalo_em_dias(vv)
+                cand_intervalo = vv["INTERVALO"]
                 if pd.notna(cand_intervalo):
                     if pd.isna(intervalo_similar):
                         intervalo_similar = cand_intervalo * score
                     else:
                         intervalo_similar += cand_intervalo * score
-            if not cc.empty:
-                cand_ult_compra = cc["DATA"].max()
+            if cc:
+                cand_ult_compra = cc["ULTIMA"]
                 if pd.notna(cand_ult_compra) and (pd.isna(ultima_compra_similar) or cand_ult_compra > ultima_compra_similar):
                     ultima_compra_similar = cand_ult_compra
 
@@ -1861,6 +3094,7 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
             "ESTOQUE_ATUAL": estoque_atual,
             "VALOR_ESTOQUE": valor_estoque,
             "CUSTO_MEDIO_FIFO": custo_fifo,
+            "CUSTO_REPOSICAO": custo_reposicao,
             "QTD_VENDIDA_TOTAL": qtd_vendida,
             "QTD_COMPRADA_TOTAL": qtd_comprada,
             "RECEITA_TOTAL": receita_total,
@@ -1878,6 +3112,8 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
             "DIAS_DESDE_ULT_COMPRA": dias_desde_ult_compra,
             "MEDIA_DIAS_COMPRA_VENDA": media_dias_compra_venda,
             "MEDIANA_DIAS_COMPRA_VENDA": mediana_dias_compra_venda,
+            "P25_DIAS_COMPRA_VENDA": lg["P25"] if lg else np.nan,
+            "P75_DIAS_COMPRA_VENDA": lg["P75"] if lg else np.nan,
             "DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA": dias_primeira_compra_ate_primeira_venda,
             "DIAS_ULTIMA_COMPRA_ATE_ULTIMA_VENDA": dias_ultima_compra_ate_ultima_venda,
             "DIAS_DESDE_ULT_VENDA_SIMILAR": dias_desde_ult_venda_similar,
@@ -1900,260 +3136,359 @@ def build_reposicao_inteligente(df_fifo, df_estoque, df_compras):
     return pd.DataFrame(linhas)
 
 
-def classificar_reposicao(row, alvo_dias=30, lead_time=10, seguranca=0.20):
-    demanda = float(row.get("DEMANDA_AJUSTADA_DIA", 0.0) or 0.0)
-    estoque = float(row.get("ESTOQUE_ATUAL", 0.0) or 0.0)
-    cobertura = float(row.get("COBERTURA_DIAS", 999.0) or 999.0)
-    dias_sem_vender = float(row.get("DIAS_DESDE_ULT_VENDA", 9999) or 9999)
-    dias_sem_vender_similar = float(row.get("DIAS_DESDE_ULT_VENDA_SIMILAR", 9999) or 9999)
-    dias_sem_comprar = float(row.get("DIAS_DESDE_ULT_COMPRA", 9999) or 9999)
-    margem = float(row.get("MARGEM_PCT", 0.0) or 0.0)
-    sell_through = float(row.get("SELL_THROUGH", 0.0) or 0.0)
-    qtd_vendida_total = float(row.get("QTD_VENDIDA_TOTAL", 0.0) or 0.0)
-    qtd_comprada_total = float(row.get("QTD_COMPRADA_TOTAL", 0.0) or 0.0)
-    v30 = float(row.get("V30", 0.0) or 0.0)
-    v60 = float(row.get("V60", 0.0) or 0.0)
-    v90 = float(row.get("V90", 0.0) or 0.0)
-    v30_similares = float(row.get("V30_SIMILARES", 0.0) or 0.0)
-    intervalo_esperado = float(row.get("INTERVALO_ESPERADO", np.nan)) if pd.notna(row.get("INTERVALO_ESPERADO", np.nan)) else np.nan
-    media_dias_compra_venda = float(row.get("MEDIA_DIAS_COMPRA_VENDA", np.nan)) if pd.notna(row.get("MEDIA_DIAS_COMPRA_VENDA", np.nan)) else np.nan
-    mediana_dias_compra_venda = float(row.get("MEDIANA_DIAS_COMPRA_VENDA", np.nan)) if pd.notna(row.get("MEDIANA_DIAS_COMPRA_VENDA", np.nan)) else np.nan
-    dias_primeira_compra_ate_primeira_venda = float(row.get("DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA", np.nan)) if pd.notna(row.get("DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA", np.nan)) else np.nan
-    dias_ultima_compra_ate_ultima_venda = float(row.get("DIAS_ULTIMA_COMPRA_ATE_ULTIMA_VENDA", np.nan)) if pd.notna(row.get("DIAS_ULTIMA_COMPRA_ATE_ULTIMA_VENDA", np.nan)) else np.nan
-
-    # Base de venda mensal: primeiro olha janela recente, mas sem se deixar enganar por 1 venda isolada.
-    venda_mensal_bruta = max(v30, v60 / 2.0, v90 / 3.0, demanda * 30.0)
-    historico_fraco = qtd_vendida_total <= 1.0 or qtd_comprada_total <= 1.0
-    historico_muito_fraco = qtd_vendida_total <= 1.0 and qtd_comprada_total <= 2.0
-    venda_isolada_recente = historico_muito_fraco and v30 > 0 and v90 <= 1.0
-
-    lag_compra_venda_ref = np.nan
-    for cand in [mediana_dias_compra_venda, media_dias_compra_venda, dias_ultima_compra_ate_ultima_venda, dias_primeira_compra_ate_primeira_venda]:
-        if pd.notna(cand):
-            lag_compra_venda_ref = float(cand)
-            break
+@st.cache_data(show_spinner=False, max_entries=2)
+def base_reposicao(_df_fifo, _df_estoque, _df_compras, _matriz_vendas, versao):
+    """build_reposicao_inteligente guardada por versão dos dados (e dia).
+
+    Só a classificação depende dos controles da tela; a base de features não muda
+    enquanto a planilha e o dia forem os mesmos.
+    """
+    return build_reposicao_inteligente(_df_fifo, _df_estoque, _df_compras, _matriz_vendas)
 
-    giro_lote_lento = pd.notna(lag_compra_venda_ref) and lag_compra_venda_ref >= 60
-    giro_lote_muito_lento = pd.notna(lag_compra_venda_ref) and lag_compra_venda_ref >= 90
 
-    if venda_isolada_recente and pd.notna(lag_compra_venda_ref):
-        venda_mensal_ref = min(venda_mensal_bruta, 30.0 / max(lag_compra_venda_ref, 1.0))
-    elif historico_muito_fraco and pd.notna(lag_compra_venda_ref):
-        venda_mensal_ref = min(venda_mensal_bruta, 30.0 / max(lag_compra_venda_ref, 1.0))
-    else:
-        venda_mensal_ref = venda_mensal_bruta
+def _num_ou(df, nome, padrao):
+    """Coluna com a regra do float(row.get(nome, padrao) or padrao): ausente, None e 0 viram o padrão; NaN fica."""
+    bruto = _coluna_ou(df, nome, padrao=padrao)
+    s = pd.to_numeric(bruto, errors="coerce").astype(float)
+    if bruto.dtype == object:
+        s = s.mask(bruto.map(lambda x: x is None), padrao)
+    return s.mask(s == 0, padrao).to_numpy()
+
+
+def _num_ou_nan(df, nome):
+    """Coluna como float; ausente ou vazio vira NaN."""
+    return pd.to_numeric(_coluna_ou(df, nome, padrao=np.nan), errors="coerce").astype(float).to_numpy()
+
+
+def _juntar_em_ordem(partes, n, sep, limite=None):
+    """Junta, linha a linha e na ordem dada, os textos cujas máscaras estão ligadas.
 
-    estoque_meses = (estoque / venda_mensal_ref) if venda_mensal_ref > 0 else (999.0 if estoque > 0 else 0.0)
-    similar_quente = v30_similares > 1.5 and dias_sem_vender_similar <= 35
+    partes = [(máscara, texto)], texto é str ou array de str; limite corta como lista[:limite].
+    """
+    saida = np.full(n, "", dtype=object)
+    usados = np.zeros(n, dtype=np.int64)
+    for mascara, texto in partes:
+        mascara = np.broadcast_to(np.asarray(mascara, dtype=bool), (n,))
+        if limite is not None:
+            mascara = mascara & (usados < limite)
+        if not mascara.any():
+            continue
+        texto = np.broadcast_to(np.asarray(texto, dtype=object), (n,))
+        saida[mascara] = np.where(usados[mascara] > 0, saida[mascara] + sep + texto[mascara], texto[mascara])
+        usados += mascara
+    return saida, usados
+
+
+def _txt_inteiro(valores, mascara, arredondar=True):
+    """int(round(x)) (ou int(x), sem arredondar) como texto onde a máscara vale."""
+    v = np.where(mascara, valores, 0.0)
+    v = np.rint(v) if arredondar else np.trunc(v)
+    return np.where(mascara, v.astype(np.int64).astype(str), "").astype(object)
+
+
+def classificar_reposicao_lote(base, alvo_dias=30, lead_time=10, seguranca=0.20, com_textos=True):
+    """Classifica a base inteira de uma vez (ação, quantidade, urgência, textos).
+
+    Regras por máscara de coluna, decididas na ordem da cascata de ações; mudar
+    um controle reclassifica milhares de produtos em milissegundos.
+    alvo_dias, lead_time e seguranca podem ser arrays (um valor por linha), o
+    que permite simular vários cenários numa passada só. com_textos=False pula
+    RESUMO_IA/MOTIVO_IA, que são a parte cara.
+    """
+    n = len(base)
+    alvo_dias = np.broadcast_to(np.asarray(alvo_dias, dtype=float), (n,))
+    lead_time = np.broadcast_to(np.asarray(lead_time, dtype=float), (n,))
+    seguranca = np.broadcast_to(np.asarray(seguranca, dtype=float), (n,))
+    demanda = _num_ou(base, "DEMANDA_AJUSTADA_DIA", 0.0)
+    estoque = _num_ou(base, "ESTOQUE_ATUAL", 0.0)
+    cobertura = _num_ou(base, "COBERTURA_DIAS", 999.0)
+    dias_sem_vender = _num_ou(base, "DIAS_DESDE_ULT_VENDA", 9999)
+    dias_sem_vender_similar = _num_ou(base, "DIAS_DESDE_ULT_VENDA_SIMILAR", 9999)
+    dias_sem_comprar = _num_ou(base, "DIAS_DESDE_ULT_COMPRA", 9999)
+    margem = _num_ou(base, "MARGEM_PCT", 0.0)
+    sell_through = _num_ou(base, "SELL_THROUGH", 0.0)
+    qtd_vendida_total = _num_ou(base, "QTD_VENDIDA_TOTAL", 0.0)
+    qtd_comprada_total = _num_ou(base, "QTD_COMPRADA_TOTAL", 0.0)
+    v30 = _num_ou(base, "V30", 0.0)
+    v60 = _num_ou(base, "V60", 0.0)
+    v90 = _num_ou(base, "V90", 0.0)
+    v30_similares = _num_ou(base, "V30_SIMILARES", 0.0)
+    intervalo_esperado = _num_ou_nan(base, "INTERVALO_ESPERADO")
+    tem_intervalo = ~np.isnan(intervalo_esperado)
+
+    venda_mensal_bruta = np.maximum.reduce([v30, v60 / 2.0, v90 / 3.0, demanda * 30.0])
+    historico_fraco = (qtd_vendida_total <= 1.0) | (qtd_comprada_total <= 1.0)
+    historico_muito_fraco = (qtd_vendida_total <= 1.0) & (qtd_comprada_total <= 2.0)
+    venda_isolada_recente = historico_muito_fraco & (v30 > 0) & (v90 <= 1.0)
+
+    # primeira referência de lag que existir, da mais robusta (mediana) para a mais fraca
+    lag_compra_venda_ref = np.full(n, np.nan)
+    for col in ["MEDIANA_DIAS_COMPRA_VENDA", "MEDIA_DIAS_COMPRA_VENDA", "DIAS_ULTIMA_COMPRA_ATE_ULTIMA_VENDA", "DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA"]:
+        lag_compra_venda_ref = np.where(np.isnan(lag_compra_venda_ref), _num_ou_nan(base, col), lag_compra_venda_ref)
+    tem_lag = ~np.isnan(lag_compra_venda_ref)
+    giro_lote_lento = tem_lag & (lag_compra_venda_ref >= 60)
+    giro_lote_muito_lento = tem_lag & (lag_compra_venda_ref >= 90)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        teto_lag = 30.0 / np.fmax(lag_compra_venda_ref, 1.0)
+        venda_mensal_ref = np.where(historico_muito_fraco & tem_lag, np.minimum(venda_mensal_bruta, teto_lag), venda_mensal_bruta)
+        estoque_meses = np.where(
+            venda_mensal_ref > 0,
+            estoque / np.where(venda_mensal_ref > 0, venda_mensal_ref, 1.0),
+            np.where(estoque > 0, 999.0, 0.0),
+        )
+    similar_quente = (v30_similares > 1.5) & (dias_sem_vender_similar <= 35)
 
     lento = (
-        (pd.notna(intervalo_esperado) and intervalo_esperado >= 45)
-        or (v90 <= 2 and dias_sem_vender >= 45)
-        or venda_mensal_ref < 1.2
-        or giro_lote_lento
+        (tem_intervalo & (intervalo_esperado >= 45))
+        | ((v90 <= 2) & (dias_sem_vender >= 45))
+        | (venda_mensal_ref < 1.2)
+        | giro_lote_lento
     )
     muito_lento = (
-        (pd.notna(intervalo_esperado) and intervalo_esperado >= 75)
-        or (v90 <= 1 and dias_sem_vender >= 80)
-        or venda_mensal_ref < 0.55
-        or giro_lote_muito_lento
+        (tem_intervalo & (intervalo_esperado >= 75))
+        | ((v90 <= 1) & (dias_sem_vender >= 80))
+        | (venda_mensal_ref < 0.55)
+        | giro_lote_muito_lento
     )
     bom_giro = (
-        v30 >= 3
-        or venda_mensal_ref >= 3.2
-        or (pd.notna(intervalo_esperado) and intervalo_esperado <= 14 and qtd_vendida_total >= 3)
+        (v30 >= 3)
+        | (venda_mensal_ref >= 3.2)
+        | (tem_intervalo & (intervalo_esperado <= 14) & (qtd_vendida_total >= 3))
     )
     otimo_giro = (
-        v30 >= 6
-        or venda_mensal_ref >= 6
-        or (pd.notna(intervalo_esperado) and intervalo_esperado <= 7 and qtd_vendida_total >= 4)
+        (v30 >= 6)
+        | (venda_mensal_ref >= 6)
+        | (tem_intervalo & (intervalo_esperado <= 7) & (qtd_vendida_total >= 4))
     )
-    excesso = (
-        estoque > 0
-        and (
-            cobertura >= max(alvo_dias * 2.2, 75)
-            or estoque_meses >= 3.0
-            or (lento and estoque >= max(2.0, venda_mensal_ref * 2.5))
-        )
-
+    excesso = (estoque > 0) & (
+        (cobertura >= np.maximum(alvo_dias * 2.2, 75))
+        | (estoque_meses >= 3.0)
+        | (lento & (estoque >= np.fmax(2.0, venda_mensal_ref * 2.5)))
+    )
+    janela_planejada = np.maximum(7, np.trunc(alvo_dias + lead_time))
+    janela_enxuta = np.maximum(lead_time + 7, np.trunc(alvo_dias * 0.65) + lead_time)
+    janela_repor = np.select(
+        [muito_lento, lento],
+        [np.maximum(lead_time + 5, np.minimum(janela_enxuta, 20)), np.maximum(lead_time + 7, np.minimum(janela_enxuta, 28))],
+        janela_planejada,
     )
-    janela_planejada = max(7, int(alvo_dias + lead_time))
-    janela_enxuta = max(lead_time + 7, int(alvo_dias * 0.65) + lead_time)
-    if muito_lento:
-        janela_repor = max(lead_time + 5, min(janela_enxuta, 20))
-    elif lento:
-        janela_repor = max(lead_time + 7, min(janela_enxuta, 28))
-    else:
-        janela_repor = janela_planejada
 
     estoque_seguranca = demanda * janela_repor * seguranca
     ponto_pedido = (demanda * lead_time) + estoque_seguranca
     estoque_alvo = (demanda * janela_repor) + estoque_seguranca
-    comprar = max(0.0, estoque_alvo - estoque)
-
-    urgencia = 0.0
-    motivo = []
-
-    if bom_giro:
-        urgencia += 18.0
-        motivo.append("tem giro real")
-    if otimo_giro:
-        urgencia += 12.0
-        motivo.append("gira rápido")
-    if margem >= 0.22:
-        urgencia += 5.0
-        motivo.append("margem boa")
-    if sell_through >= 0.75 and qtd_comprada_total >= 3:
-        urgencia += 5.0
-        motivo.append("vende boa parte do que compra")
-    if estoque <= 0 and bom_giro:
-        urgencia += 22.0
-        motivo.append("zerou mas continua com saída")
-    if cobertura <= max(lead_time, 7) and venda_mensal_ref >= 2:
-        urgencia += 20.0
-        motivo.append("estoque curto para o ritmo atual")
-    elif cobertura <= max(alvo_dias * 0.55, lead_time + 7) and venda_mensal_ref >= 1.2:
-        urgencia += 10.0
-    if dias_sem_comprar >= 45 and venda_mensal_ref >= 2 and qtd_vendida_total >= 3:
-        urgencia += 6.0
-        motivo.append("faz tempo que não recompra")
-    if similar_quente and estoque <= 0 and not bom_giro and not historico_muito_fraco:
-        urgencia += 8.0
-        motivo.append("itens parecidos seguem vendendo")
-
-    if pd.notna(intervalo_esperado) and intervalo_esperado > 0:
-        relacao = dias_sem_vender / max(intervalo_esperado, 1.0)
-        if relacao >= 2.8:
-            urgencia -= 24.0
-            motivo.append("já passou muito do ritmo normal de venda")
-        elif relacao >= 1.8:
-            urgencia -= 14.0
-            motivo.append("venda recente esfriou")
-        elif relacao >= 1.2:
-            urgencia -= 6.0
-    else:
-        if dias_sem_vender > 60:
-            urgencia -= 10.0
-        if dias_sem_vender > 120:
-            urgencia -= 14.0
-
-    if lento:
-        urgencia -= 10.0
-        motivo.append("giro lento")
-    if muito_lento:
-        urgencia -= 16.0
-        motivo.append("vende muito devagar")
-    if giro_lote_lento:
-        urgencia -= 16.0
-        motivo.append("demorou muito para girar depois da compra")
-    if giro_lote_muito_lento:
-        urgencia -= 20.0
-        motivo.append("primeiro giro do lote foi muito demorado")
-    if historico_fraco:
-        urgencia -= 8.0
-        motivo.append("histórico ainda fraco")
-    if historico_muito_fraco:
-        urgencia -= 10.0
-    if venda_isolada_recente:
-        urgencia -= 14.0
-        motivo.append("1 venda isolada recente não prova giro")
-    if excesso:
-        urgencia -= 30.0
-        motivo.append("já tem estoque suficiente por bastante tempo")
-        comprar = 0.0
-
-    if estoque <= 0 and muito_lento and not similar_quente:
-        comprar = 0.0
-    elif estoque <= 0 and lento and not bom_giro:
-        comprar = 0.0 if historico_muito_fraco else min(comprar, 1.0)
-    elif lento:
-        comprar = min(comprar, max(0.0, round(venda_mensal_ref * 0.8)))
-
-    if historico_muito_fraco and giro_lote_muito_lento:
-        comprar = 0.0
-    if venda_isolada_recente and giro_lote_lento:
-        comprar = 0.0
-    if not bom_giro and similar_quente and estoque <= 0 and comprar <= 0 and not historico_muito_fraco:
-        comprar = 1.0
-
-    urgencia = max(0.0, min(100.0, urgencia))
-
-    if excesso:
-        acao = "Não comprar agora"
-        urgencia = min(urgencia, 18.0)
-        comprar = 0.0
-    elif historico_muito_fraco and giro_lote_muito_lento:
-        acao = "Não comprar agora"
-        urgencia = min(urgencia, 10.0)
-        comprar = 0.0
-        motivo.append("zerou, mas levou meses para vender")
-    elif estoque <= 0 and muito_lento and not similar_quente:
-        acao = "Não comprar agora"
-        urgencia = min(urgencia, 15.0)
-        comprar = 0.0
-        motivo.append("zerou, mas o histórico é fraco")
-    elif estoque <= 0 and bom_giro and not giro_lote_lento:
-        acao = "Comprar já"
-        comprar = max(comprar, max(1.0, round(venda_mensal_ref * 0.9)))
-        urgencia = max(urgencia, 82.0)
-    elif cobertura <= max(lead_time, 7) and bom_giro and not giro_lote_lento:
-        acao = "Comprar já"
-        urgencia = max(urgencia, 76.0)
-    elif cobertura <= max(alvo_dias * 0.55, lead_time + 7) and venda_mensal_ref >= 1.2 and not giro_lote_muito_lento:
-        acao = "Planejar compra"
-        urgencia = max(urgencia, 56.0)
-    elif estoque <= 0 and similar_quente and not historico_muito_fraco:
-        acao = "Teste leve"
-        comprar = max(1.0, min(2.0, comprar if comprar > 0 else 1.0))
-        urgencia = max(urgencia, 40.0)
-    elif lento and estoque > 0:
-        acao = "Segurar estoque"
-        comprar = 0.0
-        urgencia = min(urgencia, 28.0)
-    else:
-        acao = "Monitorar"
+    comprar = np.fmax(0.0, estoque_alvo - estoque)
+
+    cobertura_curta = (cobertura <= np.maximum(lead_time, 7)) & (venda_mensal_ref >= 2)
+    cobertura_media = ~cobertura_curta & (cobertura <= np.maximum(alvo_dias * 0.55, lead_time + 7)) & (venda_mensal_ref >= 1.2)
+    similar_ajuda = similar_quente & (estoque <= 0) & ~bom_giro & ~historico_muito_fraco
+    with np.errstate(invalid="ignore"):
+        relacao = np.where(tem_intervalo, dias_sem_vender / np.fmax(intervalo_esperado, 1.0), np.nan)
+    ritmo = tem_intervalo & (intervalo_esperado > 0)
+    ritmo_passou = ritmo & (relacao >= 2.8)
+    ritmo_esfriou = ritmo & ~ritmo_passou & (relacao >= 1.8)
+    ritmo_atrasado = ritmo & ~ritmo_passou & ~ritmo_esfriou & (relacao >= 1.2)
+    sem_ritmo = ~ritmo
+
+    regras = [
+        # (condição, pontos de urgência, motivo)
+        (bom_giro, 18.0, "tem giro real"),
+        (otimo_giro, 12.0, "gira rápido"),
+        (margem >= 0.22, 5.0, "margem boa"),
+        ((sell_through >= 0.75) & (qtd_comprada_total >= 3), 5.0, "vende boa parte do que compra"),
+        ((estoque <= 0) & bom_giro, 22.0, "zerou mas continua com saída"),
+        (cobertura_curta, 20.0, "estoque curto para o ritmo atual"),
+        (cobertura_media, 10.0, None),
+        ((dias_sem_comprar >= 45) & (venda_mensal_ref >= 2) & (qtd_vendida_total >= 3), 6.0, "faz tempo que não recompra"),
+        (similar_ajuda, 8.0, "itens parecidos seguem vendendo"),
+        (ritmo_passou, -24.0, "já passou muito do ritmo normal de venda"),
+        (ritmo_esfriou, -14.0, "venda recente esfriou"),
+        (ritmo_atrasado, -6.0, None),
+        (sem_ritmo & (dias_sem_vender > 60), -10.0, None),
+        (sem_ritmo & (dias_sem_vender > 120), -14.0, None),
+        (lento, -10.0, "giro lento"),
+        (muito_lento, -16.0, "vende muito devagar"),
+        (giro_lote_lento, -16.0, "demorou muito para girar depois da compra"),
+        (giro_lote_muito_lento, -20.0, "primeiro giro do lote foi muito demorado"),
+        (historico_fraco, -8.0, "histórico ainda fraco"),
+        (historico_muito_fraco, -10.0, None),
+        (venda_isolada_recente, -14.0, "1 venda isolada recente não prova giro"),
+        (excesso, -30.0, "já tem estoque suficiente por bastante tempo"),
+    ]
+    urgencia = np.zeros(n)
+    for cond, pontos, _ in regras:
+        urgencia = urgencia + np.where(cond, pontos, 0.0)
+    comprar = np.where(excesso, 0.0, comprar)
+
+    zerado = estoque <= 0
+    corta_zerado_lento = zerado & muito_lento & ~similar_quente
+    limita_zerado = ~corta_zerado_lento & zerado & lento & ~bom_giro
+    limita_lento = ~corta_zerado_lento & ~limita_zerado & lento
+    comprar = np.select(
+        [corta_zerado_lento, limita_zerado, limita_lento],
+        [
+            0.0,
+            np.where(historico_muito_fraco, 0.0, np.fmin(comprar, 1.0)),
+            np.fmin(comprar, np.fmax(0.0, np.round(venda_mensal_ref * 0.8))),
+        ],
+        comprar,
+    )
+    comprar = np.where((historico_muito_fraco & giro_lote_muito_lento) | (venda_isolada_recente & giro_lote_lento), 0.0, comprar)
+    comprar = np.where(~bom_giro & similar_quente & zerado & (comprar <= 0) & ~historico_muito_fraco, 1.0, comprar)
+
+    urgencia = np.clip(urgencia, 0.0, 100.0)
+
+    # cascata de decisão: a primeira condição verdadeira decide
+    casos = [
+        excesso,
+        historico_muito_fraco & giro_lote_muito_lento,
+        zerado & muito_lento & ~similar_quente,
+        zerado & bom_giro & ~giro_lote_lento,
+        (cobertura <= np.maximum(lead_time, 7)) & bom_giro & ~giro_lote_lento,
+        (cobertura <= np.maximum(alvo_dias * 0.55, lead_time + 7)) & (venda_mensal_ref >= 1.2) & ~giro_lote_muito_lento,
+        zerado & similar_quente & ~historico_muito_fraco,
+        lento & (estoque > 0),
+    ]
+    escolha = np.select(casos, np.arange(len(casos)), len(casos))
+    acao = np.array([
+        "Não comprar agora", "Não comprar agora", "Não comprar agora", "Comprar já",
+        "Comprar já", "Planejar compra", "Teste leve", "Segurar estoque", "Monitorar",
+    ], dtype=object)[escolha]
+    urgencia = np.select(
+        [escolha == 0, escolha == 1, escolha == 2, escolha == 3, escolha == 4, escolha == 5, escolha == 6, escolha == 7],
+        [
+            np.fmin(urgencia, 18.0), np.fmin(urgencia, 10.0), np.fmin(urgencia, 15.0), np.fmax(urgencia, 82.0),
+            np.fmax(urgencia, 76.0), np.fmax(urgencia, 56.0), np.fmax(urgencia, 40.0), np.fmin(urgencia, 28.0),
+        ],
+        urgencia,
+    )
+    comprar = np.select(
+        [escolha <= 2, escolha == 3, escolha == 6, escolha == 7],
+        [
+            0.0,
+            np.fmax(comprar, np.fmax(1.0, np.round(venda_mensal_ref * 0.9))),
+            np.fmax(1.0, np.fmin(2.0, np.where(comprar > 0, comprar, 1.0))),
+            0.0,
+        ],
+        comprar,
+    )
 
-    leitura = []
-    if estoque <= 0:
-        leitura.append("sem estoque hoje")
-    else:
-        leitura.append(f"estoque atual de {int(round(estoque))} unid.")
+    qtd_recomendada = np.fmax(0.0, np.round(np.nan_to_num(comprar))).astype(np.int64)
+    if not com_textos:
+        return pd.DataFrame({
+            "PONTO_PEDIDO": ponto_pedido,
+            "ESTOQUE_ALVO": estoque_alvo,
+            "QTD_RECOMENDADA": qtd_recomendada,
+            "URGENCIA": urgencia,
+            "ACAO": acao,
+        }, index=base.index)
+
+    motivos = [(cond, txt) for cond, _, txt in regras if txt]
+    motivos += [(escolha == 1, "zerou, mas levou meses para vender"), (escolha == 2, "zerou, mas o histórico é fraco")]
+    motivo_txt, qtd_motivos = _juntar_em_ordem(motivos, n, ", ")
+    motivo_txt = np.where(qtd_motivos > 0, motivo_txt, "combinação de estoque, giro e recência")
+
+    com_v30, com_v90 = v30 > 0, (v30 <= 0) & (v90 > 0)
+    vendeu_ha, comprou_ha = dias_sem_vender < 9999, dias_sem_comprar < 9999
+    leitura = [
+        (zerado, "sem estoque hoje"),
+        (~zerado, "estoque atual de " + _txt_inteiro(estoque, ~zerado) + " unid."),
+        (com_v30, "vendeu " + _txt_inteiro(v30, com_v30) + " unid. nos últimos 30 dias"),
+        (com_v90, "vendeu " + _txt_inteiro(v90, com_v90) + " unid. nos últimos 90 dias"),
+        (~com_v30 & ~com_v90, "sem venda recente no histórico"),
+        (tem_intervalo & (qtd_vendida_total >= 2), "este item costuma sair a cada " + _txt_inteiro(intervalo_esperado, tem_intervalo) + " dias"),
+        (tem_lag, "levou cerca de " + _txt_inteiro(lag_compra_venda_ref, tem_lag) + " dias da compra até vender"),
+        (vendeu_ha, "última venda há " + _txt_inteiro(dias_sem_vender, vendeu_ha, arredondar=False) + " dias"),
+        (comprou_ha, "última compra há " + _txt_inteiro(dias_sem_comprar, comprou_ha, arredondar=False) + " dias"),
+        (similar_quente, "há item parecido com saída recente"),
+        (excesso, "já tem estoque para vários meses"),
+    ]
+    resumo, _ = _juntar_em_ordem(leitura, n, " • ", limite=6)
 
-    if v30 > 0:
-        leitura.append(f"vendeu {int(round(v30))} unid. nos últimos 30 dias")
-    elif v90 > 0:
-        leitura.append(f"vendeu {int(round(v90))} unid. nos últimos 90 dias")
-    else:
-        leitura.append("sem venda recente no histórico")
-
-    if pd.notna(intervalo_esperado) and qtd_vendida_total >= 2:
-        leitura.append(f"este item costuma sair a cada {float(intervalo_esperado):.0f} dias")
-    if pd.notna(lag_compra_venda_ref):
-        leitura.append(f"levou cerca de {float(lag_compra_venda_ref):.0f} dias da compra até vender")
-    if dias_sem_vender < 9999:
-        leitura.append(f"última venda há {int(dias_sem_vender)} dias")
-    if dias_sem_comprar < 9999:
-        leitura.append(f"última compra há {int(dias_sem_comprar)} dias")
-    if similar_quente:
-        leitura.append("há item parecido com saída recente")
-    if excesso:
-        leitura.append("já tem estoque para vários meses")
-
-    resumo = " • ".join(leitura[:6]) if leitura else "sem histórico suficiente"
-    motivo_txt = ", ".join(dict.fromkeys(motivo)) if motivo else "combinação de estoque, giro e recência"
-
-    return pd.Series({
+    return pd.DataFrame({
         "PONTO_PEDIDO": ponto_pedido,
         "ESTOQUE_ALVO": estoque_alvo,
-        "QTD_RECOMENDADA": int(max(0, round(comprar))),
+        "QTD_RECOMENDADA": qtd_recomendada,
         "URGENCIA": urgencia,
         "ACAO": acao,
         "RESUMO_IA": resumo,
         "MOTIVO_IA": motivo_txt,
+    }, index=base.index)
+
+
+ORDEM_ACOES_REPOSICAO = ["Comprar já", "Planejar compra", "Teste leve", "Monitorar", "Não comprar agora", "Segurar estoque"]
+
+
+def simular_cenarios_reposicao(base, alvos=(30,), prazos=(10,), reservas=(0.20,)):
+    """Classifica a base em todas as combinações (alvo_dias, lead_time, seguranca) numa passada só.
+
+    Repete a base uma vez por cenário, passa os parâmetros como colunas para o
+    classificar_reposicao_lote (sem os textos) e resume cada cenário: unidades
+    sugeridas, custo estimado (CUSTO_REPOSICAO: custo médio FIFO ou, sem lote
+    aberto, o da última compra), quantos produtos a comprar ficaram sem custo e
+    nº de produtos por ação.
+    """
+    cenarios = pd.MultiIndex.from_product([alvos, prazos, reservas], names=["Cobertura (dias)", "Prazo (dias)", "Reserva"])
+    n, k = len(base), len(cenarios)
+    if not n or not k:
+        return pd.DataFrame()
+    linhas = np.tile(np.arange(n), k)
+    cenario = np.repeat(np.arange(k), n)
+    grade = base.iloc[linhas].reset_index(drop=True)
+    calc = classificar_reposicao_lote(
+        grade,
+        alvo_dias=cenarios.get_level_values(0).to_numpy(dtype=float)[cenario],
+        lead_time=cenarios.get_level_values(1).to_numpy(dtype=float)[cenario],
+        seguranca=cenarios.get_level_values(2).to_numpy(dtype=float)[cenario],
+        com_textos=False,
+    )
+    custo = np.nan_to_num(_num_ou(grade, "CUSTO_REPOSICAO", 0.0))
+    calc["CENARIO"] = cenario
+    calc["CUSTO"] = calc["QTD_RECOMENDADA"] * custo
+    calc["SEM_CUSTO"] = (calc["QTD_RECOMENDADA"] > 0) & (custo <= 0)
+    resumo = calc.groupby("CENARIO").agg(**{
+        "Qtd sugerida": ("QTD_RECOMENDADA", "sum"),
+        "Custo estimado": ("CUSTO", "sum"),
+        "Sem custo (SKUs)": ("SEM_CUSTO", "sum"),
     })
+    por_acao = pd.crosstab(calc["CENARIO"], calc["ACAO"]).reindex(columns=ORDEM_ACOES_REPOSICAO, fill_value=0)
+    out = resumo.join(por_acao).reindex(range(k), fill_value=0)
+    out.index = cenarios
+    return out.reset_index()
+
+
+def nivel_confianca_lote(base):
+    """Confiança da recomendação (Alta/Média/Baixa) pelos pontos de histórico de cada produto."""
+    qtd = _num_ou(base, "QTD_VENDIDA_TOTAL", 0)
+    v30 = _num_ou(base, "V30", 0)
+    v60 = _num_ou(base, "V60", 0)
+    intervalo = _num_ou_nan(base, "INTERVALO_ESPERADO")
+    lag = _num_ou_nan(base, "DIAS_PRIMEIRA_COMPRA_ATE_PRIMEIRA_VENDA")
+    sim = _num_ou(base, "V30_SIMILARES", 0)
+    pontos = (
+        np.select([qtd >= 6, qtd >= 4, qtd >= 2, qtd >= 1], [45, 36, 24, 10], 0)
+        + np.select([v30 >= 3, v60 >= 4, v60 >= 2], [25, 18, 10], 0)
+        + np.where(~np.isnan(intervalo), 15, 0)
+        - np.select([lag >= 90, lag >= 60], [18, 10], 0)
+        - np.where(qtd <= 1, 18, 0)
+        - np.where((qtd <= 1) & (sim > 0), 8, 0)
+    )
+    pontos = np.clip(pontos, 0, 100)
+    return pd.Series(np.select([pontos >= 70, pontos >= 45], ["Alta", "Média"], "Baixa"), index=base.index, dtype=object)
+
 
+def risco_analise_lote(base, confianca=None):
+    """Risco da análise (Baixo/Médio/Alto) a partir da confiança; aceita a já calculada."""
+    if confianca is None:
+        confianca = nivel_confianca_lote(base)
+    qtd = _num_ou(base, "QTD_VENDIDA_TOTAL", 0)
+    sim = _num_ou(base, "V30_SIMILARES", 0)
+    risco = confianca.map({"Alta": "Baixo", "Média": "Médio"}).fillna("Alto").to_numpy(dtype=object)
+    risco = np.where((qtd <= 1) & (sim > 0), "Alto", risco)
+    return pd.Series(risco, index=base.index, dtype=object)
 
-def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_estoque, df_compras, estoque_atual_map):
+
+def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_estoque, df_compras, estoque_atual_map, matriz_vendas=None, indice_produtos=None):
     linha_est = df_estoque[df_estoque["PRODUTO"] == prod_sel]
     if not linha_est.empty:
         saldo = float(linha_est["SALDO_QTD"].iloc[0])
@@ -2187,12 +3522,24 @@ def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_
 
     st.markdown(f"### 📦 {prod_sel}")
 
-    relacionados = buscar_produtos_relacionados(busca_produto, todos_produtos, estoque_atual_map, limite=12) if busca_produto else pd.DataFrame()
+    if not busca_produto:
+        relacionados = pd.DataFrame()
+    elif indice_produtos is not None:
+        relacionados = buscar_produtos_indice(busca_produto, indice_produtos, limite=12)
+    else:
+        relacionados = buscar_produtos_relacionados(busca_produto, todos_produtos, estoque_atual_map, limite=12)
+    sugeridos = []
     if not relacionados.empty:
-        relacionados = relacionados[relacionados["PRODUTO"] != prod_sel].head(5)
-        if not relacionados.empty:
-            sugestoes = " • ".join([label_produto_busca(p, estoque_atual_map) for p in relacionados["PRODUTO"].tolist()])
-            st.caption(f"Talvez você também esteja procurando: {sugestoes}")
+        sugeridos = relacionados.loc[relacionados["PRODUTO"] != prod_sel, "PRODUTO"].head(5).tolist()
+    # completa com os vizinhos do grafo de similares (mesmo usado na reposição)
+    for nome, _ in grafo_similares(tuple(todos_produtos)).get(prod_sel, []):
+        if len(sugeridos) >= 5:
+            break
+        if nome != prod_sel and nome not in sugeridos:
+            sugeridos.append(nome)
+    if sugeridos:
+        sugestoes = " • ".join([label_produto_busca(p, estoque_atual_map) for p in sugeridos])
+        st.caption(f"Talvez você também esteja procurando: {sugestoes}")
 
     cA, cB, cC = st.columns(3)
     with cA:
@@ -2229,6 +3576,11 @@ def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_
             unsafe_allow_html=True,
         )
 
+    janelas_txt = "Somatório das vendas registradas"
+    if matriz_vendas is not None and prod_sel in matriz_vendas["posicao"]:
+        v = vendas_ultimos_dias(matriz_vendas, pd.Timestamp.now().normalize()).iloc[matriz_vendas["posicao"][prod_sel]]
+        janelas_txt = f"Últimos 30/60/90 dias: {v['V30']:,.0f} / {v['V60']:,.0f} / {v['V90']:,.0f}"
+
     cD, cE, cF = st.columns(3)
     with cD:
         st.markdown(
@@ -2258,7 +3610,7 @@ def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_
 <div class="kpi-card">
   <div class="kpi-label">Qtd total vendida</div>
   <div class="kpi-value">{int(qtd_total_vendida)} unid.</div>
-  <div class="kpi-pill">Somatório das vendas registradas</div>
+  <div class="kpi-pill">{janelas_txt}</div>
 </div>
 """,
             unsafe_allow_html=True,
@@ -2315,42 +3667,26 @@ def render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_
     st.markdown("---")
     st.markdown("#### 🧾 Histórico de compras (ENTREGUE)")
 
-    compras_prod = df_compras.copy()
-    compras_prod.columns = [c.strip().upper() for c in compras_prod.columns]
-
-    if "PRODUTO" in compras_prod.columns:
-        compras_prod = compras_prod[compras_prod["PRODUTO"] == prod_sel].copy()
+    # df_compras já vem da base canônica (tipada, colunas em maiúsculo).
+    if "PRODUTO" in df_compras.columns:
+        compras_prod = filtrar_entregues(df_compras[df_compras["PRODUTO"] == prod_sel])
     else:
         compras_prod = pd.DataFrame()
 
-    if not compras_prod.empty and "STATUS" in compras_prod.columns:
-        compras_prod = compras_prod[
-            compras_prod["STATUS"].astype(str).str.upper() == "ENTREGUE"
-        ].copy()
-
     if compras_prod.empty:
         st.info("Nenhuma compra ENTREGUE registrada para esse produto.")
     else:
         if "DATA" in compras_prod.columns:
-            compras_prod["DATA"] = pd.to_datetime(
-                compras_prod["DATA"], errors="coerce", dayfirst=True
-            )
             compras_prod = compras_prod.sort_values("DATA", ascending=False)
             compras_prod["DATA_FMT"] = compras_prod["DATA"].dt.strftime("%d/%m/%Y")
         else:
             compras_prod["DATA_FMT"] = ""
 
-        if "QUANTIDADE" in compras_prod.columns:
-            compras_prod["QUANTIDADE"] = compras_prod["QUANTIDADE"].apply(parse_money).astype(float)
-        else:
-            compras_prod["QUANTIDADE"] = 0.0
-
-        if "CUSTO UNITÁRIO" in compras_prod.columns:
-            compras_prod["CUSTO UNITÁRIO"] = compras_prod["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
-        else:
-            compras_prod["CUSTO UNITÁRIO"] = 0.0
-
-        compras_prod["CUSTO_TOTAL"] = compras_prod.get("CUSTO_TOTAL", compras_prod["QUANTIDADE"] * compras_prod["CUSTO UNITÁRIO"])
+        for _col in ["QUANTIDADE", "CUSTO UNITÁRIO"]:
+            if _col not in compras_prod.columns:
+                compras_prod[_col] = 0.0
+        if "CUSTO_TOTAL" not in compras_prod.columns:
+            compras_prod["CUSTO_TOTAL"] = compras_prod["QUANTIDADE"] * compras_prod["CUSTO UNITÁRIO"]
         compras_prod["CUSTO_UNIT_FMT"] = compras_prod["CUSTO UNITÁRIO"].map(format_reais)
         compras_prod["CUSTO_TOTAL_FMT"] = compras_prod["CUSTO_TOTAL"].map(format_reais)
 
@@ -2482,7 +3818,7 @@ if nav == "📊 Dashboard":
 
     status_geral = df_fifo.get("STATUS", "").astype(str).str.strip().str.upper()
     df_receber_geral = normalize_sales_like(df_fifo.loc[status_geral != "FATURADO"].copy())
-    valor_a_receber_nao_faturado = df_receber_geral.apply(calcular_saldo_a_receber, axis=1).sum() if not df_receber_geral.empty else 0.0
+    valor_a_receber_nao_faturado = calcular_saldo_a_receber(df_receber_geral).sum() if not df_receber_geral.empty else 0.0
 
     qtd_total = df_fifo_faturado_filt["QTD"].sum()
     total_vendido = df_fifo_faturado_filt["VALOR_TOTAL"].sum()
@@ -2492,8 +3828,8 @@ if nav == "📊 Dashboard":
     num_vendas = len(df_fifo_faturado_filt)
 
     # Indicadores de não faturados
-    lucro_previsto = df_receber_geral.apply(calcular_lucro_a_receber, axis=1).sum() if not df_receber_geral.empty else 0.0
-    custo_preso = df_receber_geral.apply(calcular_custo_proporcional_a_receber, axis=1).sum() if not df_receber_geral.empty else 0.0
+    lucro_previsto = calcular_lucro_a_receber(df_receber_geral).sum() if not df_receber_geral.empty else 0.0
+    custo_preso = calcular_custo_proporcional_a_receber(df_receber_geral).sum() if not df_receber_geral.empty else 0.0
     qtd_nao_faturadas = len(df_receber_geral)
     clientes_devendo = df_receber_geral["CLIENTE"].astype(str).nunique() if (not df_receber_geral.empty and "CLIENTE" in df_receber_geral.columns) else 0
 
@@ -2548,21 +3884,7 @@ if nav == "📊 Dashboard":
     else:
         valor_estoque_total = 0.0
 
-    dfc = df_compras.copy()
-    dfc.columns = [c.strip().upper() for c in dfc.columns]
-
-    if "DATA" in dfc.columns:
-        dfc["DATA"] = pd.to_datetime(dfc["DATA"], errors="coerce", dayfirst=True)
-        dfc["MES_ANO"] = dfc["DATA"].dt.strftime("%Y-%m")
-    if "STATUS" in dfc.columns:
-        dfc = dfc[dfc["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
-
-    if "QUANTIDADE" in dfc.columns:
-        dfc["QUANTIDADE"] = dfc["QUANTIDADE"].apply(parse_money).astype(float)
-    if "CUSTO UNITÁRIO" in dfc.columns:
-        dfc["CUSTO UNITÁRIO"] = dfc["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
-
-    dfc["CUSTO_TOTAL"] = dfc.get("QUANTIDADE", 0) * dfc.get("CUSTO UNITÁRIO", 0)
+    dfc = df_compras_entregues
 
     if mes_selecionado == "Todos":
         total_compras_periodo = dfc["CUSTO_TOTAL"].sum()
@@ -2613,20 +3935,9 @@ if nav == "📊 Dashboard":
         )
 
         # --- Resumo de COMPRAS (ENTREGUE) por mês ---
-        dfc_graf = df_compras.copy()
+        dfc_graf = df_compras_entregues
         if isinstance(dfc_graf, pd.DataFrame) and not dfc_graf.empty:
-            dfc_graf.columns = [str(c).strip().upper() for c in dfc_graf.columns]
-            if "STATUS" in dfc_graf.columns:
-                dfc_graf = dfc_graf[dfc_graf["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
-            if "DATA" in dfc_graf.columns:
-                dfc_graf["DATA"] = pd.to_datetime(dfc_graf["DATA"], errors="coerce", dayfirst=True)
-                dfc_graf["MES_ANO"] = dfc_graf["DATA"].dt.strftime("%Y-%m")
-            if "QUANTIDADE" in dfc_graf.columns:
-                dfc_graf["QUANTIDADE"] = dfc_graf["QUANTIDADE"].apply(parse_money).astype(float)
-            if "CUSTO UNITÁRIO" in dfc_graf.columns:
-                dfc_graf["CUSTO UNITÁRIO"] = dfc_graf["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
             if "MES_ANO" in dfc_graf.columns:
-                dfc_graf["CUSTO_TOTAL"] = dfc_graf.get("QUANTIDADE", 0) * dfc_graf.get("CUSTO UNITÁRIO", 0)
                 resumo_compras = (
                     dfc_graf.groupby("MES_ANO", as_index=False)["CUSTO_TOTAL"]
                     .sum()
@@ -2722,7 +4033,8 @@ if nav == "📊 Dashboard":
             fig.update_xaxes(showgrid=False)
             fig.update_yaxes(showgrid=True, gridcolor="#1f2937", zeroline=False)
 
-            st.plotly_chart(fig, use_container_width=True)
+            with medir_etapa("plotly"):
+                st.plotly_chart(fig, use_container_width=True)
 
     st.markdown("---")
 
@@ -2795,24 +4107,25 @@ if nav == "📊 Dashboard":
         )
         # --- Tabela compacta (🔍 abre na Pesquisa) ---
         headers = ["Produto", "Qtd", "Estoque", "Custo FIFO", "Preço médio", "Receita", "Lucro"]
-        rows = []
-        for _, r in tabela_top.iterrows():
-            prod = _safe(r.get("Produto", ""))
-            link = f"?produto={quote(prod)}"
-            prod_html = produto_cell_html(prod, before_lens=True)
-            rows.append(
-                "<tr>"
-                + _td(prod_html)
-                + _td(_safe(int(r.get("Qtd vendida", 0))))
-                + _td(_safe(int(r.get("Estoque atual", 0))))
-                + _td(_safe(r.get("Custo médio FIFO (unid.)", "")))
-                + _td(_safe(r.get("Preço médio venda (unid.)", "")))
-                + _td(_safe(r.get("Receita total", "")))
-                + _td(_safe(r.get("Lucro total (FIFO)", "")))
-                + "</tr>"
-            )
+        with medir_etapa("tabelas HTML"):
+            rows = []
+            for _, r in tabela_top.iterrows():
+                prod = _safe(r.get("Produto", ""))
+                link = f"?produto={quote(prod)}"
+                prod_html = produto_cell_html(prod, before_lens=True)
+                rows.append(
+                    "<tr>"
+                    + _td(prod_html)
+                    + _td(_safe(int(r.get("Qtd vendida", 0))))
+                    + _td(_safe(int(r.get("Estoque atual", 0))))
+                    + _td(_safe(r.get("Custo médio FIFO (unid.)", "")))
+                    + _td(_safe(r.get("Preço médio venda (unid.)", "")))
+                    + _td(_safe(r.get("Receita total", "")))
+                    + _td(_safe(r.get("Lucro total (FIFO)", "")))
+                    + "</tr>"
+                )
 
-        st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+            st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
 
 
         # Top produtos com maior lucro total
@@ -2855,23 +4168,24 @@ if nav == "📊 Dashboard":
         )
 
         headers_lucro = ["Produto", "Qtd", "Estoque", "Lucro/unid.", "Receita", "Lucro total"]
-        rows_lucro = []
-        for _, r in tabela_lucro.iterrows():
-            prod = _safe(r.get("Produto", ""))
-            link = f"?produto={quote(prod)}"
-            prod_html = produto_cell_html(prod, before_lens=True)
-            rows_lucro.append(
-                "<tr>"
-                + _td(prod_html)
-                + _td(_safe(int(r.get("Qtd vendida", 0))))
-                + _td(_safe(int(r.get("Estoque atual", 0))))
-                + _td(_safe(r.get("Lucro por unid.", "")))
-                + _td(_safe(r.get("Receita total", "")))
-                + _td(_safe(r.get("Lucro total (FIFO)", "")))
-                + "</tr>"
-            )
+        with medir_etapa("tabelas HTML"):
+            rows_lucro = []
+            for _, r in tabela_lucro.iterrows():
+                prod = _safe(r.get("Produto", ""))
+                link = f"?produto={quote(prod)}"
+                prod_html = produto_cell_html(prod, before_lens=True)
+                rows_lucro.append(
+                    "<tr>"
+                    + _td(prod_html)
+                    + _td(_safe(int(r.get("Qtd vendida", 0))))
+                    + _td(_safe(int(r.get("Estoque atual", 0))))
+                    + _td(_safe(r.get("Lucro por unid.", "")))
+                    + _td(_safe(r.get("Receita total", "")))
+                    + _td(_safe(r.get("Lucro total (FIFO)", "")))
+                    + "</tr>"
+                )
 
-        st.markdown(_render_compact_table(rows_lucro, headers_lucro), unsafe_allow_html=True)
+            st.markdown(_render_compact_table(rows_lucro, headers_lucro), unsafe_allow_html=True)
 
     st.markdown("---")
 
@@ -2925,7 +4239,7 @@ if nav == "📊 Dashboard":
         df_sales['DATA_FMT'] = df_sales['DATA'].dt.strftime('%d/%m/%Y').fillna('')
 
         # numéricos
-        df_sales['QTD_NUM'] = df_sales['QTD'].apply(parse_money).astype(float)
+        df_sales['QTD_NUM'] = parse_money_series(df_sales['QTD'])
         df_sales['QTD_INT'] = df_sales['QTD_NUM'].apply(lambda x: int(round(float(x))) if pd.notna(x) else 0)
 
         # normaliza ESTOQUE_ATUAL (garante Series)
@@ -2935,12 +4249,12 @@ if nav == "📊 Dashboard":
             _est = pd.Series(0, index=df_sales.index)
         df_sales['ESTOQUE_ATUAL'] = _est.apply(lambda x: int(round(float(x))) if pd.notna(x) else 0)
 
-        df_sales['VALOR_TOTAL'] = df_sales['VALOR_TOTAL'].apply(parse_money).astype(float)
-        df_sales['LUCRO'] = df_sales['LUCRO'].apply(parse_money).astype(float)
+        df_sales['VALOR_TOTAL'] = parse_money_series(df_sales['VALOR_TOTAL'])
+        df_sales['LUCRO'] = parse_money_series(df_sales['LUCRO'])
 
         # custo total e custo unitário FIFO (blindado)
         if 'CUSTO_TOTAL' in df_sales.columns:
-            df_sales['CUSTO_TOTAL'] = df_sales['CUSTO_TOTAL'].apply(parse_money).astype(float)
+            df_sales['CUSTO_TOTAL'] = parse_money_series(df_sales['CUSTO_TOTAL'])
         else:
             df_sales['CUSTO_TOTAL'] = 0.0
 
@@ -2965,41 +4279,42 @@ if nav == "📊 Dashboard":
         )
 
         headers = ['Data', 'Produto', 'Cliente', 'Status', 'Qtd', 'Estoque', 'Custo un. (FIFO)', 'Valor', 'Lucro']
-        rows = []
-        for i, r in df_sales.iterrows():
-            prod = _safe(r.get('PRODUTO', ''))
-            emoji_giro = _safe(r.get('EMOJI_GIRO_PARADO', ''))
-            giro_label = _safe(r.get('GIRO_PARADO_LABEL', ''))
-            dias_parado = r.get('DIAS_PARADO_ANTES_VENDA', pd.NA)
-            data_html = _safe(r.get('DATA_FMT', ''))
-            if emoji_giro:
-                title_data = giro_label or 'venda de item que ficou muito tempo parado'
-                if pd.notna(dias_parado):
-                    data_html = f"<span title='{_attr_safe(title_data)}'>{data_html} {emoji_giro}</span>"
+        with medir_etapa("tabelas HTML"):
+            rows = []
+            for i, r in df_sales.iterrows():
+                prod = _safe(r.get('PRODUTO', ''))
+                emoji_giro = _safe(r.get('EMOJI_GIRO_PARADO', ''))
+                giro_label = _safe(r.get('GIRO_PARADO_LABEL', ''))
+                dias_parado = r.get('DIAS_PARADO_ANTES_VENDA', pd.NA)
+                data_html = _safe(r.get('DATA_FMT', ''))
+                if emoji_giro:
+                    title_data = giro_label or 'venda de item que ficou muito tempo parado'
+                    if pd.notna(dias_parado):
+                        data_html = f"<span title='{_attr_safe(title_data)}'>{data_html} {emoji_giro}</span>"
+                    else:
+                        data_html = f"<span title='{_attr_safe(title_data)}'>{data_html} {emoji_giro}</span>"
+
+                prod_base_html = produto_cell_html(prod, before_lens=True)
+                if emoji_giro:
+                    prod_html = f"<div title='{_attr_safe(giro_label)}'>{prod_base_html}<div class='muted' style='font-size:11px;margin-top:4px;'>{emoji_giro} {_safe(giro_label)}</div></div>"
                 else:
-                    data_html = f"<span title='{_attr_safe(title_data)}'>{data_html} {emoji_giro}</span>"
+                    prod_html = prod_base_html
 
-            prod_base_html = produto_cell_html(prod, before_lens=True)
-            if emoji_giro:
-                prod_html = f"<div title='{_attr_safe(giro_label)}'>{prod_base_html}<div class='muted' style='font-size:11px;margin-top:4px;'>{emoji_giro} {_safe(giro_label)}</div></div>"
-            else:
-                prod_html = prod_base_html
-
-            rows.append(
-                '<tr>'
-                + _td(data_html, 'muted')
-                + _td(prod_html)
-                + _td(_safe(r.get('CLIENTE', '')))
-                + _td(_safe(r.get('STATUS', '')), 'muted')
-                + _td(_safe(r.get('QTD_INT', 0)))
-                + _td(_safe(r.get('ESTOQUE_ATUAL', 0)), 'muted')
-                + _td(_safe(r.get('CUSTO_UNIT_FIFO_FMT', '')), 'muted')
-                + _td(_safe(r.get('VALOR_FMT', '')))
-                + _td(_safe(r.get('LUCRO_FMT', '')))
-                + '</tr>'
-            )
+                rows.append(
+                    '<tr>'
+                    + _td(data_html, 'muted')
+                    + _td(prod_html)
+                    + _td(_safe(r.get('CLIENTE', '')))
+                    + _td(_safe(r.get('STATUS', '')), 'muted')
+                    + _td(_safe(r.get('QTD_INT', 0)))
+                    + _td(_safe(r.get('ESTOQUE_ATUAL', 0)), 'muted')
+                    + _td(_safe(r.get('CUSTO_UNIT_FIFO_FMT', '')), 'muted')
+                    + _td(_safe(r.get('VALOR_FMT', '')))
+                    + _td(_safe(r.get('LUCRO_FMT', '')))
+                    + '</tr>'
+                )
 
-        st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+            st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
 
     else:
         st.info("Nenhuma venda no período selecionado.")
@@ -3022,7 +4337,7 @@ elif nav == "💵 Fiados / Não faturados":
     for _col in ["QTD", "VALOR_TOTAL", "CUSTO_TOTAL", "LUCRO"]:
         if _col not in df_receber.columns:
             df_receber[_col] = 0
-        df_receber[_col] = df_receber[_col].apply(parse_money).astype(float)
+        df_receber[_col] = parse_money_series(df_receber[_col])
 
     if "STATUS" not in df_receber.columns:
         df_receber["STATUS"] = ""
@@ -3042,10 +4357,10 @@ elif nav == "💵 Fiados / Não faturados":
         df_receber["CLIENTE_VIEW"] = df_receber["CLIENTE"].astype(str).str.strip()
         df_receber.loc[df_receber["CLIENTE_VIEW"].eq(""), "CLIENTE_VIEW"] = "SEM CLIENTE"
 
-        df_receber["SALDO_A_RECEBER"] = df_receber.apply(calcular_saldo_a_receber, axis=1).astype(float)
+        df_receber["SALDO_A_RECEBER"] = calcular_saldo_a_receber(df_receber)
         df_receber["VALOR_JA_PAGO"] = (df_receber["VALOR_TOTAL"] - df_receber["SALDO_A_RECEBER"]).clip(lower=0)
-        df_receber["CUSTO_PROPORCIONAL"] = df_receber.apply(calcular_custo_proporcional_a_receber, axis=1).astype(float)
-        df_receber["LUCRO_A_RECEBER"] = df_receber.apply(calcular_lucro_a_receber, axis=1).astype(float)
+        df_receber["CUSTO_PROPORCIONAL"] = calcular_custo_proporcional_a_receber(df_receber)
+        df_receber["LUCRO_A_RECEBER"] = calcular_lucro_a_receber(df_receber)
 
         total_venda = float(df_receber["VALOR_TOTAL"].sum())
         total_a_receber = float(df_receber["SALDO_A_RECEBER"].sum())
@@ -3198,7 +4513,7 @@ elif nav == "🔎 Pesquisa de produto":
     with col_voltar:
         if st.button("← Voltar", key="btn_voltar_pesquisa"):
             st.session_state["_nav_pending"] = st.session_state.get("voltar_para_tab", "📊 Dashboard")
-            st.rerun()
+            refazer_rerun()
 
     if df_fifo.empty and df_estoque.empty:
         st.info("Sem dados de estoque ou vendas para pesquisar.")
@@ -3224,10 +4539,10 @@ elif nav == "🔎 Pesquisa de produto":
         with col_ajuda:
             st.caption('Use aspas para frase exata. Ex.: "fone kz"')
 
-        resultado_busca = buscar_produtos_relacionados(
+        indice_produtos = indice_busca(todos_produtos, estoque_atual_map, (versao_dados, fifo_backend, _hoje_str()))
+        resultado_busca = buscar_produtos_indice(
             busca_produto,
-            todos_produtos,
-            estoque_atual_map,
+            indice_produtos,
             limite=max(1000, len(todos_produtos))
         )
 
@@ -3281,7 +4596,11 @@ elif nav == "🔎 Pesquisa de produto":
 
         if prod_sel and prod_sel != "(selecione)":
             st.session_state.produto_pesquisa = prod_sel
-            render_product_details(prod_sel, busca_produto, todos_produtos, df_fifo, df_estoque, df_compras, estoque_atual_map)
+            with medir_etapa("detalhes do produto"):
+                render_product_details(
+                    prod_sel, busca_produto, todos_produtos, df_fifo, df_estoque, df_compras, estoque_atual_map, matriz_vendas,
+                    indice_produtos,
+                )
         else:
             st.info("Digite algo para filtrar e escolha um produto para ver os detalhes baseados no FIFO.")
 
@@ -3333,11 +4652,7 @@ elif nav == "⚠️ Alertas":
         )
 
         # Base para "vendendo bem e com pouco estoque"
-        vendas_tot = (
-            df_fifo.groupby("PRODUTO", as_index=False)["QTD"]
-            .sum()
-            .rename(columns={"QTD": "QTD_VENDIDA_TOTAL"})
-        )
+        vendas_tot = pd.DataFrame({"PRODUTO": matriz_vendas["produtos"], "QTD_VENDIDA_TOTAL": matriz_vendas["total"]})
         base_alerta = df_estoque.merge(vendas_tot, on="PRODUTO", how="left")
         base_alerta["QTD_VENDIDA_TOTAL"] = base_alerta["QTD_VENDIDA_TOTAL"].fillna(0)
 
@@ -3357,19 +4672,20 @@ elif nav == "⚠️ Alertas":
             df_vb = df_vb.sort_values(["SALDO_QTD", "QTD_VENDIDA_TOTAL"], ascending=[True, False])
 
             headers = ["Produto", "Estoque atual", "Qtd vendida (histórico)", "Valor em estoque (FIFO)", "Abrir"]
-            rows = []
-            for _, r in df_vb.iterrows():
-                prod = r.get("PRODUTO", "")
-                rows.append(
-                    "<tr>"
-                    + _td(produto_cell_html(prod))
-                    + _td(_safe(r.get("SALDO_QTD", 0)))
-                    + _td(_safe(r.get("QTD_VENDIDA_TOTAL", 0)))
-                    + _td(_safe(r.get("VALOR_ESTOQUE_FMT", "")), "muted")
-                    + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
-                    + "</tr>"
-                )
-            st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+            with medir_etapa("tabelas HTML"):
+                rows = []
+                for _, r in df_vb.iterrows():
+                    prod = r.get("PRODUTO", "")
+                    rows.append(
+                        "<tr>"
+                        + _td(produto_cell_html(prod))
+                        + _td(_safe(r.get("SALDO_QTD", 0)))
+                        + _td(_safe(r.get("QTD_VENDIDA_TOTAL", 0)))
+                        + _td(_safe(r.get("VALOR_ESTOQUE_FMT", "")), "muted")
+                        + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
+                        + "</tr>"
+                    )
+                st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
 
         valor_estoque_total_geral = float(df_estoque["VALOR_ESTOQUE"].sum()) if (not df_estoque.empty and "VALOR_ESTOQUE" in df_estoque.columns) else 0.0
         st.markdown("### 🐌 Estoque parado há muito tempo")
@@ -3486,26 +4802,27 @@ elif nav == "⚠️ Alertas":
 """, unsafe_allow_html=True)
 
                     headers = ["Produto", "Estoque atual", "Valor parado (FIFO)", "Maior idade", "Idade média", "Lotes", "Faixa", "% do estoque", "Lote mais antigo", "Lote mais recente", "Abrir"]
-                    rows = []
-                    for _, r in parado_filtrado.iterrows():
-                        prod = r.get("PRODUTO", "")
-                        pct = float(r.get("PCT_ESTOQUE_TOTAL", 0) or 0)
-                        rows.append(
-                            "<tr>"
-                            + _td(produto_cell_html(prod))
-                            + _td(_safe(r.get("SALDO_QTD", 0)))
-                            + _td(_safe(r.get("VALOR_ESTOQUE_FMT", "")), "muted")
-                            + _td(_safe(r.get("DIAS_PARADO", 0)))
-                            + _td(_safe(r.get("DIAS_MEDIO_PONDERADO", 0)), "muted")
-                            + _td(_safe(r.get("LOTES_ABERTOS", 0)))
-                            + _td(_safe(r.get("FAIXA", "")))
-                            + _td(f"{pct:.1f}%", "muted")
-                            + _td(_safe(r.get("DATA_LOTE_ANTIGO_FMT", "")), "muted")
-                            + _td(_safe(r.get("DATA_LOTE_RECENTE_FMT", "")), "muted")
-                            + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
-                            + "</tr>"
-                        )
-                    st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+                    with medir_etapa("tabelas HTML"):
+                        rows = []
+                        for _, r in parado_filtrado.iterrows():
+                            prod = r.get("PRODUTO", "")
+                            pct = float(r.get("PCT_ESTOQUE_TOTAL", 0) or 0)
+                            rows.append(
+                                "<tr>"
+                                + _td(produto_cell_html(prod))
+                                + _td(_safe(r.get("SALDO_QTD", 0)))
+                                + _td(_safe(r.get("VALOR_ESTOQUE_FMT", "")), "muted")
+                                + _td(_safe(r.get("DIAS_PARADO", 0)))
+                                + _td(_safe(r.get("DIAS_MEDIO_PONDERADO", 0)), "muted")
+                                + _td(_safe(r.get("LOTES_ABERTOS", 0)))
+                                + _td(_safe(r.get("FAIXA", "")))
+                                + _td(f"{pct:.1f}%", "muted")
+                                + _td(_safe(r.get("DATA_LOTE_ANTIGO_FMT", "")), "muted")
+                                + _td(_safe(r.get("DATA_LOTE_RECENTE_FMT", "")), "muted")
+                                + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
+                                + "</tr>"
+                            )
+                        st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
 
         # ----------------------------------------
         # PAINEL SAÚDE DA LOJA
@@ -3614,11 +4931,12 @@ Agora a leitura ficou mais humana: estoque zerado não significa comprar no auto
         unsafe_allow_html=True,
     )
 
-    base_ia = build_reposicao_inteligente(df_fifo, df_estoque, df_compras)
+    with medir_etapa("build_reposicao_inteligente"):
+        base_ia = base_reposicao(df_fifo, df_estoque, df_compras, matriz_vendas, (versao_dados, fifo_backend, _hoje_str()))
 
-    if base_ia.empty:
-        st.info("Ainda não há base suficiente para sugerir reposição.")
-    else:
+    @st.fragment
+    def _painel_reposicao(base_ia):
+        """Controles e classificação: mexer num controle só reroda este trecho, com a base já pronta."""
         st.markdown(
             """
 <div class="section-sub">
@@ -3699,14 +5017,11 @@ Passe o mouse nos ícones de atenção para entender cada parte sem poluir a tel
                 unsafe_allow_html=True,
             )
 
-        calc = base_ia.apply(
-            lambda row: classificar_reposicao(
-                row,
-                alvo_dias=int(cobertura_dias),
-                lead_time=int(lead_time),
-                seguranca=float(seguranca),
-            ),
-            axis=1,
+        calc = classificar_reposicao_lote(
+            base_ia,
+            alvo_dias=int(cobertura_dias),
+            lead_time=int(lead_time),
+            seguranca=float(seguranca),
         )
         base_ia = pd.concat([base_ia, calc], axis=1)
 
@@ -3717,12 +5032,12 @@ Passe o mouse nos ícones de atenção para entender cada parte sem poluir a tel
             + ((base_ia["V30_SIMILARES"].fillna(0) > 0).astype(int) * 4)
         )
 
-        ordem_acoes = ["Comprar já", "Planejar compra", "Teste leve", "Monitorar", "Não comprar agora", "Segurar estoque"]
+        ordem_acoes = ORDEM_ACOES_REPOSICAO
         ordem_map = {acao: i + 1 for i, acao in enumerate(ordem_acoes)}
         base_ia["ORDEM_ACAO_NUM"] = base_ia["ACAO"].map(ordem_map).fillna(99).astype(int)
         base_ia["ORDEM_ACAO"] = pd.Categorical(base_ia["ACAO"], categories=ordem_acoes, ordered=True)
-        base_ia["CONFIANCA_IA"] = base_ia.apply(_nivel_confianca, axis=1)
-        base_ia["RISCO_IA"] = base_ia.apply(_risco_analise, axis=1)
+        base_ia["CONFIANCA_IA"] = nivel_confianca_lote(base_ia)
+        base_ia["RISCO_IA"] = risco_analise_lote(base_ia, base_ia["CONFIANCA_IA"])
 
         def _numero_seguro(valor, padrao=0.0):
             try:
@@ -3763,7 +5078,7 @@ Passe o mouse nos ícones de atenção para entender cada parte sem poluir a tel
 
         total_para_comprar = int(view["QTD_RECOMENDADA"].fillna(0).sum()) if not view.empty else 0
         produtos_criticos = int((view["ACAO"].isin(["Comprar já"])).sum()) if not view.empty else 0
-        capital_estimado = float((view["QTD_RECOMENDADA"].fillna(0) * view["CUSTO_MEDIO_FIFO"].fillna(0)).sum()) if not view.empty else 0.0
+        capital_estimado = float((view["QTD_RECOMENDADA"].fillna(0) * view["CUSTO_REPOSICAO"].fillna(0)).sum()) if not view.empty else 0.0
         itens_teste = int((view["ACAO"] == "Teste leve").sum()) if not view.empty else 0
         capital_parado_medio = int(view["CAPITAL_PARADO_DIAS"].clip(lower=0).mean()) if not view.empty else 0
 
@@ -3834,24 +5149,25 @@ A ordem olha quatro coisas ao mesmo tempo: o que vendeu, há quantos dias vendeu
             tabela["PRIORIDADE_FMT"] = tabela["URGENCIA"].apply(lambda x: f"{float(x):.0f}/100")
 
             headers = ["Ação sugerida", "Produto", "Prioridade", "Sugestão", "Estoque", "Cobertura", "Leitura da IA"]
-            rows = []
-            for _, r in tabela.iterrows():
-                prod = _safe(r.get("PRODUTO", ""))
-                link = f"?produto={quote(prod)}"
-                prod_html = produto_cell_html(prod, before_lens=True)
-                leitura_hover = f'<span class="hover-cell">{_mini_hover(_painel_resultado_text(r), icon="🧠")}<span class="muted">passar mouse</span></span>'
-                rows.append(
-                    "<tr>"
-                    + _td(_acao_badge(r.get("ACAO", "")))
-                    + _td(prod_html)
-                    + _td(_safe(r.get("PRIORIDADE_FMT", "")), "muted")
-                    + _td(_safe(r.get("QTD_RECOMENDADA", 0)))
-                    + _td(_safe(r.get("ESTOQUE_ATUAL", 0)))
-                    + _td(_safe(r.get("COBERTURA_DIAS_FMT", "")), "muted")
-                    + _td(leitura_hover, "muted")
-                    + "</tr>"
-                )
-            st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+            with medir_etapa("tabelas HTML"):
+                rows = []
+                for _, r in tabela.iterrows():
+                    prod = _safe(r.get("PRODUTO", ""))
+                    link = f"?produto={quote(prod)}"
+                    prod_html = produto_cell_html(prod, before_lens=True)
+                    leitura_hover = f'<span class="hover-cell">{_mini_hover(_painel_resultado_text(r), icon="🧠")}<span class="muted">passar mouse</span></span>'
+                    rows.append(
+                        "<tr>"
+                        + _td(_acao_badge(r.get("ACAO", "")))
+                        + _td(prod_html)
+                        + _td(_safe(r.get("PRIORIDADE_FMT", "")), "muted")
+                        + _td(_safe(r.get("QTD_RECOMENDADA", 0)))
+                        + _td(_safe(r.get("ESTOQUE_ATUAL", 0)))
+                        + _td(_safe(r.get("COBERTURA_DIAS_FMT", "")), "muted")
+                        + _td(leitura_hover, "muted")
+                        + "</tr>"
+                    )
+                st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
 
         st.markdown("---")
         st.markdown(
@@ -3889,54 +5205,88 @@ Aqui o sistema abre o raciocínio em português claro, para você bater o olho e
             detalhe["COBERTURA_FMT"] = detalhe["COBERTURA_DIAS"].apply(lambda x: "sem giro" if pd.isna(x) or float(x) >= 999 else f"{float(x):.1f} dias")
 
             headers = ["Ação", "Produto", "Prioridade", "Est./Sug.", "Movimento", "Datas", "Ritmo", "Motivo", "IA"]
-            rows = []
-            for _, r in detalhe.iterrows():
-                prod = _safe(r.get("PRODUTO", ""))
-                link = f"?produto={quote(prod)}"
-                prod_html = produto_cell_html(prod, before_lens=True)
-                motivo_hover = f'<span class="hover-cell">{_mini_hover(r.get("MOTIVO_IA", "Sem motivo disponível"), icon="⚠️")}<span class="muted">ver</span></span>'
-                resumo_hover = f'<span class="hover-cell">{_mini_hover(_painel_resultado_text(r), icon="🧠")}<span class="muted">ver</span></span>'
-                estoque_sug_html = (
-                    f'<div style="line-height:1.25">'
-                    f'<div><strong>{_safe(r.get("ESTOQUE_FMT", 0))}</strong> em estoque</div>'
-                    f'<div class="muted">sugestão: {_safe(r.get("QTD_FMT", 0))}</div>'
-                    f'</div>'
-                )
-                movimento_html = (
-                    f'<div style="line-height:1.25">'
-                    f'<div>30d: <strong>{_safe(r.get("V30_FMT", 0))}</strong></div>'
-                    f'<div class="muted">60d: {_safe(r.get("V60_FMT", 0))}</div>'
-                    f'</div>'
-                )
-                datas_html = (
-                    f'<div style="line-height:1.25">'
-                    f'<div>venda: <strong>{_safe(r.get("DIAS_VENDA_FMT", "—"))}</strong>d</div>'
-                    f'<div class="muted">compra: {_safe(r.get("DIAS_COMPRA_FMT", "—"))}d • parecido: {_safe(r.get("DIAS_SIMILAR_FMT", "—"))}d</div>'
-                    f'</div>'
-                )
-                ritmo_html = (
-                    f'<div style="line-height:1.25">'
-                    f'<div>médio: <strong>{_safe(r.get("INTERVALO_FMT", "—"))}</strong>d</div>'
-                    f'<div class="muted">cobertura: {_safe(r.get("COBERTURA_FMT", ""))}</div>'
-                    f'</div>'
-                )
-                rows.append(
-                    "<tr>"
-                    + _td(_acao_badge(r.get("ACAO", "")))
-                    + _td(prod_html)
-                    + _td(_safe(r.get("PRIORIDADE_FMT", "")), "muted")
-                    + _td(estoque_sug_html)
-                    + _td(movimento_html)
-                    + _td(datas_html, "muted")
-                    + _td(ritmo_html, "muted")
-                    + _td(motivo_hover, "muted")
-                    + _td(resumo_hover, "muted")
-                    + "</tr>"
-                )
-            st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+            with medir_etapa("tabelas HTML"):
+                rows = []
+                for _, r in detalhe.iterrows():
+                    prod = _safe(r.get("PRODUTO", ""))
+                    link = f"?produto={quote(prod)}"
+                    prod_html = produto_cell_html(prod, before_lens=True)
+                    motivo_hover = f'<span class="hover-cell">{_mini_hover(r.get("MOTIVO_IA", "Sem motivo disponível"), icon="⚠️")}<span class="muted">ver</span></span>'
+                    resumo_hover = f'<span class="hover-cell">{_mini_hover(_painel_resultado_text(r), icon="🧠")}<span class="muted">ver</span></span>'
+                    estoque_sug_html = (
+                        f'<div style="line-height:1.25">'
+                        f'<div><strong>{_safe(r.get("ESTOQUE_FMT", 0))}</strong> em estoque</div>'
+                        f'<div class="muted">sugestão: {_safe(r.get("QTD_FMT", 0))}</div>'
+                        f'</div>'
+                    )
+                    movimento_html = (
+                        f'<div style="line-height:1.25">'
+                        f'<div>30d: <strong>{_safe(r.get("V30_FMT", 0))}</strong></div>'
+                        f'<div class="muted">60d: {_safe(r.get("V60_FMT", 0))}</div>'
+                        f'</div>'
+                    )
+                    datas_html = (
+                        f'<div style="line-height:1.25">'
+                        f'<div>venda: <strong>{_safe(r.get("DIAS_VENDA_FMT", "—"))}</strong>d</div>'
+                        f'<div class="muted">compra: {_safe(r.get("DIAS_COMPRA_FMT", "—"))}d • parecido: {_safe(r.get("DIAS_SIMILAR_FMT", "—"))}d</div>'
+                        f'</div>'
+                    )
+                    ritmo_html = (
+                        f'<div style="line-height:1.25">'
+                        f'<div>médio: <strong>{_safe(r.get("INTERVALO_FMT", "—"))}</strong>d</div>'
+                        f'<div class="muted">cobertura: {_safe(r.get("COBERTURA_FMT", ""))}</div>'
+                        f'</div>'
+                    )
+                    rows.append(
+                        "<tr>"
+                        + _td(_acao_badge(r.get("ACAO", "")))
+                        + _td(prod_html)
+                        + _td(_safe(r.get("PRIORIDADE_FMT", "")), "muted")
+                        + _td(estoque_sug_html)
+                        + _td(movimento_html)
+                        + _td(datas_html, "muted")
+                        + _td(ritmo_html, "muted")
+                        + _td(motivo_hover, "muted")
+                        + _td(resumo_hover, "muted")
+                        + "</tr>"
+                    )
+                st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
         else:
             st.info("Nada para detalhar com o filtro atual.")
 
+        st.markdown("---")
+        st.markdown(
+            """
+<div class="section-title">🧪 Comparar cenários</div>
+<div class="section-sub">
+Roda várias combinações de cobertura, prazo e reserva de uma vez e mostra quanto cada plano pediria de compra.
+</div>
+""",
+            unsafe_allow_html=True,
+        )
+        if st.checkbox("Simular cenários de reposição", value=False):
+            s1, s2, s3 = st.columns(3)
+            with s1:
+                alvos_sim = st.multiselect(
+                    "Coberturas (dias)", list(range(10, 121, 5)), default=sorted({30, 45, 60, 90, int(cobertura_dias)})
+                )
+            with s2:
+                prazos_sim = st.multiselect("Prazos (dias)", sorted(prazos.values()), default=sorted(prazos.values()))
+            with s3:
+                reservas_sim = st.multiselect(
+                    "Reservas", sorted(set(mapa_reserva.values())), default=sorted(set(mapa_reserva.values())),
+                    format_func=lambda x: f"{int(x*100)}%",
+                )
+            with medir_etapa("cenários de reposição"):
+                cenarios = simular_cenarios_reposicao(base_ia, alvos_sim, prazos_sim, reservas_sim)
+            if cenarios.empty:
+                st.info("Escolha ao menos um valor em cada controle para simular.")
+            else:
+                cenarios["Reserva"] = cenarios["Reserva"].map(lambda x: f"{int(round(x*100))}%")
+                cenarios["Custo estimado"] = cenarios["Custo estimado"].map(format_reais)
+                st.dataframe(cenarios, use_container_width=True, hide_index=True)
+                st.caption(f"{len(cenarios)} cenário(s) • custo pelo custo médio FIFO (sem lote aberto, pela última compra) • contagem de produtos por ação sugerida.")
+
         st.markdown("---")
         st.markdown(
             """
@@ -3960,6 +5310,11 @@ Nada de mágica de fumaça: ela segue sinais reais da sua operação.
 """
         )
 
+    if base_ia.empty:
+        st.info("Ainda não há base suficiente para sugerir reposição.")
+    else:
+        _painel_reposicao(base_ia)
+
 elif nav == "🧾 Compras":
     st.markdown(
         """
@@ -3971,30 +5326,11 @@ Visão das compras da loja por mês, com foco no que realmente importa para o ca
         unsafe_allow_html=True,
     )
 
-    dfc = df_compras.copy()
-    dfc.columns = [c.strip().upper() for c in dfc.columns]
+    dfc = df_compras_entregues
 
     if "DATA" not in dfc.columns:
         st.info("A aba COMPRAS da planilha precisa ter uma coluna 'DATA'.")
     else:
-        dfc["DATA"] = pd.to_datetime(dfc["DATA"], errors="coerce", dayfirst=True)
-
-        if "STATUS" in dfc.columns:
-            dfc = dfc[dfc["STATUS"].astype(str).str.upper() == "ENTREGUE"].copy()
-
-        if "QUANTIDADE" in dfc.columns:
-            dfc["QUANTIDADE"] = dfc["QUANTIDADE"].apply(parse_money).astype(float)
-        else:
-            dfc["QUANTIDADE"] = 0.0
-
-        if "CUSTO UNITÁRIO" in dfc.columns:
-            dfc["CUSTO UNITÁRIO"] = dfc["CUSTO UNITÁRIO"].apply(parse_money).astype(float)
-        else:
-            dfc["CUSTO UNITÁRIO"] = 0.0
-
-        dfc["CUSTO_TOTAL"] = dfc["QUANTIDADE"] * dfc["CUSTO UNITÁRIO"]
-        dfc["MES_ANO"] = dfc["DATA"].dt.strftime("%Y-%m")
-
         if dfc["MES_ANO"].dropna().empty:
             st.info("Não encontrei compras com DATA válida para montar a aba de Compras.")
         else:
@@ -4107,19 +5443,20 @@ Veja onde está indo o dinheiro das compras, em quantidade e valor.
                     top_comp["VALOR_COMP_FMT"] = top_comp["VALOR_COMP"].map(format_reais)
 
                     headers = ["Produto", "Qtd comprada", "Valor em compras", "Estoque atual", "Abrir"]
-                    rows = []
-                    for _, r in top_comp.head(20).iterrows():
-                        prod = r.get("PRODUTO", "")
-                        rows.append(
-                            "<tr>"
-                            + _td(produto_cell_html(prod))
-                            + _td(int(round(float(r.get("QTD_COMP", 0) or 0))))
-                            + _td(_safe(r.get("VALOR_COMP_FMT", "")), "muted")
-                            + _td(int(round(float(r.get("ESTOQUE_ATUAL", 0) or 0))))
-                            + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
-                            + "</tr>"
-                        )
-                    st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+                    with medir_etapa("tabelas HTML"):
+                        rows = []
+                        for _, r in top_comp.head(20).iterrows():
+                            prod = r.get("PRODUTO", "")
+                            rows.append(
+                                "<tr>"
+                                + _td(produto_cell_html(prod))
+                                + _td(int(round(float(r.get("QTD_COMP", 0) or 0))))
+                                + _td(_safe(r.get("VALOR_COMP_FMT", "")), "muted")
+                                + _td(int(round(float(r.get("ESTOQUE_ATUAL", 0) or 0))))
+                                + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
+                                + "</tr>"
+                            )
+                        st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
                 else:
                     st.info("Não encontrei coluna 'PRODUTO' na aba de COMPRAS.")
 
@@ -4140,7 +5477,7 @@ Cada lançamento com data, produto, quantidade e custo — e o estoque atual do
                 # Blindagem: se por algum motivo não for DataFrame, não quebra
                 if not isinstance(dfc_view, pd.DataFrame):
                     st.error("Erro interno: compras detalhadas inválidas (dfc_view não é DataFrame).")
-                    st.stop()
+                    parar_rerun()
 
                 # adiciona estoque atual em cada linha da compra
                 try:
@@ -4181,23 +5518,33 @@ Cada lançamento com data, produto, quantidade e custo — e o estoque atual do
                     .sort_values("Data", ascending=False)
                 )
                 headers = ["Data", "Produto", "Status", "Qtd", "Custo unitário", "Custo total", "Estoque atual", "Mês/ano", "Abrir"]
-                rows = []
-                for _, r in dfc_compact.head(200).iterrows():
-                    prod = r.get("Produto", "")
-                    rows.append(
-                        "<tr>"
-                        + _td(_safe(r.get("Data", "")), "muted")
-                        + _td(produto_cell_html(prod))
-                        + _td(_safe(r.get("Status", "")))
-                        + _td(_safe(r.get("Qtd", 0)))
-                        + _td(_safe(r.get("Custo unitário", "")), "muted")
-                        + _td(_safe(r.get("Custo total", "")), "muted")
-                        + _td(_safe(r.get("Estoque atual", 0)))
-                        + _td(_safe(r.get("Mês/ano", "")), "muted")
-                        + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
-                        + "</tr>"
-                    )
-                st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
+                with medir_etapa("tabelas HTML"):
+                    rows = []
+                    for _, r in dfc_compact.head(200).iterrows():
+                        prod = r.get("Produto", "")
+                        rows.append(
+                            "<tr>"
+                            + _td(_safe(r.get("Data", "")), "muted")
+                            + _td(produto_cell_html(prod))
+                            + _td(_safe(r.get("Status", "")))
+                            + _td(_safe(r.get("Qtd", 0)))
+                            + _td(_safe(r.get("Custo unitário", "")), "muted")
+                            + _td(_safe(r.get("Custo total", "")), "muted")
+                            + _td(_safe(r.get("Estoque atual", 0)))
+                            + _td(_safe(r.get("Mês/ano", "")), "muted")
+                            + _td(criar_link_lupa(prod, title="Abrir detalhes do produto"))
+                            + "</tr>"
+                        )
+                    st.markdown(_render_compact_table(rows, headers), unsafe_allow_html=True)
                 st.caption("Mostrando até 200 compras mais recentes nesta tabela compacta.")
 
 
+# --------------------------------------------------
+# DEBUG DE DESEMPENHO (?debug=1)
+# --------------------------------------------------
+fechar_rerun(
+    nav,
+    produtos=sorted(set(df_compras["PRODUTO"].dropna().astype(str)) | set(df_vendas["PRODUTO"].dropna().astype(str)))
+    if st.session_state.get("_debug") else (),
+    leitura=leitura_planilha,
+)
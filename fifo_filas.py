@@ -0,0 +1,56 @@
+"""Replay FIFO por filas de lotes, sem Streamlit.
+
+Fica fora do app.py para os processos filhos do motor paralelo (spawn)
+importarem só isto, sem rodar o dashboard de novo.
+"""
+from collections import deque
+
+import numpy as np
+
+
+def montar_filas_fifo(produtos, quantidades, custos_unit, datas, estoque=None):
+    """Monta uma fila de lotes por produto, na ordem das compras.
+
+    Cada lote é uma lista [qtd, custo_unit, data]; o deque deixa tirar o lote
+    da frente em O(1) quando a venda consome tudo dele. Se vier um estoque
+    já montado, os lotes novos entram no fim das filas existentes.
+    """
+    estoque = {} if estoque is None else estoque
+    for produto, qtd, custo_unit, data_lote in zip(produtos, quantidades, custos_unit, datas):
+        if qtd <= 0:
+            continue
+        fila = estoque.get(produto)
+        if fila is None:
+            fila = estoque[produto] = deque()
+        fila.append([float(qtd), float(custo_unit), data_lote])
+    return estoque
+
+
+def consumir_filas_fifo(estoque, produtos, quantidades):
+    """Baixa as vendas das filas (mutando estoque) e devolve o custo FIFO de cada venda."""
+    custos = np.zeros(len(produtos), dtype=float)
+    for i, (produto, qtd_venda) in enumerate(zip(produtos, quantidades)):
+        lotes = estoque.get(produto)
+        if not lotes:
+            continue
+        restante = float(qtd_venda)
+        custo_total = 0.0
+        while restante > 0 and lotes:
+            lote = lotes[0]
+            if lote[0] <= restante:
+                custo_total += lote[0] * lote[1]
+                restante -= lote[0]
+                lotes.popleft()
+            else:
+                custo_total += restante * lote[1]
+                lote[0] -= restante
+                restante = 0
+        custos[i] = custo_total
+    return custos
+
+
+def fifo_particao(lotes_cols, vendas_cols):
+    """Replay de um pedaço de produtos (roda dentro do processo filho)."""
+    estoque = montar_filas_fifo(*lotes_cols)
+    custos = consumir_filas_fifo(estoque, *vendas_cols)
+    return custos, estoque